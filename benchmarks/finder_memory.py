@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Memory and lookup benchmark for the frecklecutable finder.
+
+Creates a number of context repos with generated frecklecutables, and compares the memory
+used by the finder's caches with the former representation (one '{"path": ..., "type": "file"}'
+dict per frecklecutable, kept in both the per-path and the global cache), as well as the
+time of repeated 'get_all_dictlets' and 'get_dictlet' calls.
+
+Usage:
+
+    python benchmarks/finder_memory.py [--repos 20] [--frecklecutables 500] [--lookups 10000]
+
+Requires Python 3.4+ (for tracemalloc).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import tracemalloc
+from collections import OrderedDict
+from timeit import default_timer
+
+from frecklecute.utils import FrecklecutableFinder, find_frecklecutable_dirs, find_frecklecutables_in_folder
+
+
+def create_repos(base, repos, frecklecutables):
+
+    paths = []
+    for r in range(repos):
+        folder = os.path.join(base, "repo_{}".format(r), "frecklecutables")
+        os.makedirs(folder)
+        for i in range(frecklecutables):
+            with open(os.path.join(folder, "frecklecutable-{}-{}".format(r, i)), "w") as f:
+                f.write("tasks:\n  - debug\n")
+        paths.append(os.path.dirname(folder))
+    return paths
+
+
+def legacy_caches(paths):
+    """Builds the caches the way the finder used to."""
+
+    path_cache = {}
+    frecklecutable_cache = {}
+    for path in paths:
+        commands = OrderedDict()
+        for f_dir in find_frecklecutable_dirs(path):
+            commands.update(find_frecklecutables_in_folder(f_dir))
+        path_cache[path] = commands
+        frecklecutable_cache.update(commands)
+    return (path_cache, frecklecutable_cache)
+
+
+def legacy_get_all_dictlets(path_cache, paths):
+
+    result = OrderedDict()
+    for path in paths:
+        result.update(path_cache[path])
+    return result
+
+
+def measure(func):
+
+    tracemalloc.start()
+    result = func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, size)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repos", type=int, default=20)
+    parser.add_argument("--frecklecutables", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="frecklecute_bench_")
+    try:
+        paths = create_repos(base, args.repos, args.frecklecutables)
+        names = ["frecklecutable-{}-{}".format(r % args.repos, r % args.frecklecutables) for r in range(args.lookups)]
+
+        (path_cache, frecklecutable_cache), legacy_size = measure(lambda: legacy_caches(paths))
+
+        def create_finder():
+            finder = FrecklecutableFinder(paths)
+            finder.get_all_dictlets()
+            return finder
+
+        finder, size = measure(create_finder)
+
+        start = default_timer()
+        for name in names:
+            legacy_get_all_dictlets(path_cache, paths).get(name)
+        legacy_time = default_timer() - start
+
+        start = default_timer()
+        for name in names:
+            finder.get_dictlet(name)
+        lookup_time = default_timer() - start
+
+        total = args.repos * args.frecklecutables
+        print("frecklecutables: {}".format(total))
+        print("cache memory (legacy): {:>10.1f} KiB ({:.0f} bytes per frecklecutable)".format(legacy_size / 1024, legacy_size / total))
+        print("cache memory (current): {:>9.1f} KiB ({:.0f} bytes per frecklecutable)".format(size / 1024, size / total))
+        print("{} lookups (legacy, merged copy per call): {:.3f}s".format(args.lookups, legacy_time))
+        print("{} lookups (current, index): {:.3f}s".format(args.lookups, lookup_time))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""asyncio-native execution of frecklecutables, for embedding frecklecute in long-running services.
+
+This module requires Python 3.5 or newer, and is not imported by any of the other frecklecute modules.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import tempfile
+from functools import partial
+from timeit import default_timer
+
+from nsbl import defaults as nsbl_defaults, nsbl
+
+from freckles.freckles_defaults import *
+from freckles.utils import DEFAULT_FRECKLES_CONFIG
+from .frecklecute import Frecklecute
+from .roles import get_local_role_repos
+
+log = logging.getLogger("freckles")
+
+# the line limit for the output stream of a run, lines longer than that are dropped
+DEFAULT_LINE_LIMIT = 2 ** 20
+# time to wait for a terminated run to exit before it gets killed
+DEFAULT_TERMINATE_GRACE_PERIOD = 5.0
+
+TASK_STATUS_CATEGORIES = ["ok", "failed", "skipped", "item_ok", "item_failed"]
+
+RUN_FOLDER_PREFIX = "run_async_"
+
+
+def render_run_environment(run, f, hosts, run_base=None):
+    """Renders the Ansible environment for a frecklecutable, without executing it.
+
+    This is blocking, and meant to be run in an executor. Unlike
+    :func:`freckles.utils.create_and_run_nsbl_runner` (which this mirrors, apart from the target
+    folder and the output format), every render gets its own, unique run folder (instead of one
+    with a timestamp of second-resolution that would be overwritten by a concurrent render), so any
+    number of renders can happen at the same time. The 'current' run symlink is not updated.
+
+    Run folders are kept, like the archived folders of synchronous runs.
+
+    Args:
+      run (Frecklecute): the object holding the run configuration
+      f (Frecklecutable): the frecklecutable to render
+      hosts (list): the target hosts
+      run_base (str): the folder to create the run folder in, defaults to the freckles run archive folder
+
+    Returns:
+      dict: the run parameters, as returned by the nsbl runner
+    """
+
+    callback, additional_roles = run.prepare_run_callback(f)
+
+    config = run.config
+    if not config:
+        config = DEFAULT_FRECKLES_CONFIG
+
+    role_repos = nsbl_defaults.calculate_role_repos(get_local_role_repos(config), use_default_roles=False)
+
+    nsbl_obj = nsbl.Nsbl.create(f.task_config, role_repos, config.task_descs, wrap_into_hosts=hosts, pre_chain=[],
+                                additional_roles=additional_roles)
+    runner = nsbl.NsblRunner(nsbl_obj)
+
+    if run_base is None:
+        run_base = os.path.dirname(os.path.expanduser(DEFAULT_RUN_LOCATION))
+    if not os.path.isdir(run_base):
+        os.makedirs(run_base)
+    run_target = tempfile.mkdtemp(dir=run_base, prefix=RUN_FOLDER_PREFIX)
+
+    run_kwargs = {}
+    if run.password is not None:
+        run_kwargs["password"] = run.password
+
+    # the 'nsbl_internal' callback emits one json event per line
+    return runner.run(run_target, force=True, ask_become_pass=run.ask_become_pass, extra_plugins=EXTRA_FRECKLES_PLUGINS,
+                      callback="nsbl_internal", no_run=True, display_sub_tasks=True, display_skipped_tasks=False,
+                      display_ignore_tasks=DEFAULT_IGNORE_STRINGS, pre_run_callback=callback, **run_kwargs)
+
+
+def get_running_loop():
+
+    # 'asyncio.get_running_loop' is only available on Python 3.7+
+    if hasattr(asyncio, "get_running_loop"):
+        return asyncio.get_running_loop()
+    return asyncio.get_event_loop()
+
+
+class AsyncFrecklecuteRun(object):
+    """A single, already rendered frecklecutable run, executed as an asyncio subprocess.
+
+    Iterating over an object of this class (with 'async for') starts the run if necessary and yields
+    one task event (a dict, as emitted by the 'nsbl_internal' Ansible callback) per output line.
+    Lines that can't be parsed are yielded with the category 'output'. Output is never buffered
+    beyond the current line.
+
+    Cancelling the task that consumes the events, or exceeding the timeout, terminates the whole
+    process group of the run.
+
+    Args:
+      name (str): the name of the frecklecutable
+      parameters (dict): the run parameters of the rendered environment (needs to contain 'run_playbooks_script')
+      metrics (RunMetrics): optional metrics object to record task counts and durations in
+      timeout (float): optional timeout for the whole run, in seconds
+      line_limit (int): the maximum length of a single output line
+      remove_run_folder (bool): whether to delete the run folder ('env_dir') once the run finished
+    """
+
+    def __init__(self, name, parameters, metrics=None, timeout=None, line_limit=DEFAULT_LINE_LIMIT,
+                 remove_run_folder=False):
+
+        self.name = name
+        self.parameters = parameters
+        self.metrics = metrics
+        self.timeout = timeout
+        self.line_limit = line_limit
+        self.remove_run_folder = remove_run_folder
+
+        self.process = None
+        self.return_code = None
+        self._deadline = None
+        self._start = None
+
+    async def start(self):
+        """Starts the run."""
+
+        if self.process is not None:
+            return
+
+        run_env = os.environ.copy()
+        run_env["NSBL_ENVIRONMENT"] = "true"
+
+        self._start = default_timer()
+        if self.timeout is not None:
+            self._deadline = self._start + self.timeout
+
+        self.process = await asyncio.create_subprocess_shell(
+            self.parameters["run_playbooks_script"],
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=run_env,
+            limit=self.line_limit,
+            start_new_session=True)
+
+    def _remaining_time(self):
+
+        if self._deadline is None:
+            return None
+        return max(self._deadline - default_timer(), 0)
+
+    async def terminate(self, grace_period=DEFAULT_TERMINATE_GRACE_PERIOD):
+        """Terminates the run (and all its child processes), killing it if it doesn't exit in time."""
+
+        if self.process is None or self.process.returncode is not None:
+            return
+
+        self._signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), grace_period)
+        except asyncio.TimeoutError:
+            self._signal(signal.SIGKILL)
+            await self.process.wait()
+        self._finish()
+
+    def _signal(self, sig):
+
+        try:
+            os.killpg(self.process.pid, sig)
+        except (ProcessLookupError):
+            pass
+
+    def _finish(self):
+
+        if self.return_code is not None:
+            return
+
+        self.return_code = self.process.returncode
+        self.parameters["return_code"] = self.return_code
+
+        if self.metrics is not None:
+            self.metrics.inc("run_duration_seconds", default_timer() - self._start, frecklecutable=self.name, phase="execute")
+            self.metrics.set("run_return_code", self.return_code, frecklecutable=self.name)
+            self.metrics.set_run_status(self.name, self.return_code)
+
+        if self.remove_run_folder and self.parameters.get("env_dir", None):
+            shutil.rmtree(self.parameters["env_dir"], ignore_errors=True)
+
+    def _parse_line(self, line):
+
+        line = line.decode("utf-8", errors="replace").strip()
+        try:
+            event = json.loads(line)
+        except (ValueError):
+            event = None
+        if not isinstance(event, dict) or "category" not in event.keys():
+            event = {"category": "output", "msg": line}
+
+        if self.metrics is not None:
+            category = event["category"]
+            if category in TASK_STATUS_CATEGORIES:
+                self.metrics.inc("tasks", frecklecutable=self.name, status=category)
+            if event.get("status", None) == "changed":
+                self.metrics.inc("tasks", frecklecutable=self.name, status="changed")
+
+        return event
+
+    def __aiter__(self):
+
+        return self
+
+    async def __anext__(self):
+
+        await self.start()
+
+        while True:
+            try:
+                line = await asyncio.wait_for(self.process.stdout.readline(), self._remaining_time())
+            except asyncio.TimeoutError:
+                log.warning("Run of frecklecutable '{}' timed out, terminating it.".format(self.name))
+                await self.terminate()
+                raise
+            except asyncio.CancelledError:
+                await self.terminate()
+                raise
+            except (ValueError) as e:
+                # line longer than the limit, the stream discards it
+                log.warning("Dropping output line of frecklecutable '{}': {}".format(self.name, e))
+                continue
+
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            return self._parse_line(line)
+
+        await self.process.wait()
+        self._finish()
+        raise StopAsyncIteration
+
+    async def wait(self):
+        """Runs until the process exits, discarding all task events.
+
+        Returns:
+          dict: the run parameters, including the 'return_code'
+        """
+
+        while True:
+            try:
+                await self.__anext__()
+            except StopAsyncIteration:
+                break
+
+        return self.parameters
+
+    async def __aenter__(self):
+
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        await self.terminate()
+
+
+class AsyncFrecklecute(Frecklecute):
+    """asyncio-native version of :class:`~frecklecute.frecklecute.Frecklecute`.
+
+    The Ansible environment is rendered in the default executor (into its own run folder), the
+    actual run is managed as an asyncio subprocess, so any number of runs can share one event loop
+    without a thread each.
+
+    Unlike the synchronous version, this doesn't run the 'box basics' bootstrap before each run, and
+    it doesn't print anything. 'ask_become_pass' can't be used, as the run has no terminal.
+
+    Every run gets its own run folder in 'run_base' (the freckles run archive folder by default).
+    Run folders are kept, unless 'remove_run_folders' is set, in which case they are deleted once
+    their run finished (runs that are only rendered are always kept).
+
+    Args:
+      frecklecutables: a frecklecutable, or a list of them
+      run_base (str): the folder to create run folders in
+      remove_run_folders (bool): whether to delete run folders after their run finished
+      **kwargs: the arguments of :class:`~frecklecute.frecklecute.Frecklecute`
+    """
+
+    def __init__(self, frecklecutables, run_base=None, remove_run_folders=False, **kwargs):
+
+        super(AsyncFrecklecute, self).__init__(frecklecutables, **kwargs)
+        self.run_base = run_base
+        self.remove_run_folders = remove_run_folders
+
+    async def prepare_frecklecute_run(self, frecklecutable, hosts=["localhost"], timeout=None):
+        """Renders the environment for a frecklecutable.
+
+        Returns:
+          AsyncFrecklecuteRun: the (not yet started) run
+        """
+
+        f = self.frecklecutables.get(frecklecutable, False)
+        if not f:
+            raise Exception(
+                "No frecklecutable '{}' found".format(frecklecutable))
+
+        if self.ask_become_pass is True:
+            raise Exception("Can't ask for a become password in an asynchronous run.")
+
+        self.metrics.set("tasks", len(f.tasks), frecklecutable=f.name, status="planned")
+
+        loop = get_running_loop()
+        with self.metrics.timer("run_duration_seconds", frecklecutable=f.name, phase="render"):
+            parameters = await loop.run_in_executor(
+                None, partial(render_run_environment, self, f, hosts, run_base=self.run_base))
+
+        return AsyncFrecklecuteRun(f.name, parameters, metrics=self.metrics, timeout=timeout,
+                                   remove_run_folder=self.remove_run_folders)
+
+    async def start_frecklecute_run(self, frecklecutable, hosts=["localhost"], no_run=False, timeout=None):
+        """Renders and (unless 'no_run' is specified) executes a frecklecutable.
+
+        Returns:
+          dict: the run parameters, including the 'return_code' if the run was executed
+        """
+
+        run = await self.prepare_frecklecute_run(frecklecutable, hosts=hosts, timeout=timeout)
+        if no_run:
+            return run.parameters
+
+        result = await run.wait()
+        return result
+
+    async def execute(self, hosts=["localhost"], no_run=False, timeout=None):
+        """Executes all frecklecutables, one after the other.
+
+        If a host prober is configured, the target hosts are probed (concurrently) first.
+
+        Returns:
+          list: the run parameters of all runs
+        """
+
+        if self.host_prober is not None:
+            with self.metrics.timer("preflight_duration_seconds"):
+                probe_results = await self.host_prober.probe_hosts(hosts)
+            hosts = self.filter_reachable_hosts(probe_results)
+
+        results = []
+        for f in self.frecklecutables.keys():
+            r = await self.start_frecklecute_run(f, hosts=hosts, no_run=no_run, timeout=timeout)
+            results.append(r)
+
+        return results
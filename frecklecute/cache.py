@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk cache for the inputs of prepared (rendered) frecklecutables."""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+from collections import OrderedDict
+
+from six import integer_types, string_types
+
+from . import __version__
+
+log = logging.getLogger("freckles")
+
+DEFAULT_RENDER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "cache", "frecklecute", "rendered")
+DEFAULT_RENDER_CACHE_MAX_SIZE = 50 * 1024 * 1024
+RENDER_CACHE_FILE_EXTENSION = ".json"
+
+
+def is_json_lossless(value, loaded):
+    """Checks whether a value is the same as the result of serializing it to json and loading it again.
+
+    Tuples and lists are considered the same, everything else needs to keep its type (e.g. dict keys
+    that are not strings, or objects that are not json types, are not lossless).
+    """
+
+    if isinstance(value, dict):
+        return isinstance(loaded, dict) and len(value) == len(loaded) and \
+            all(isinstance(k, string_types) and k in loaded and is_json_lossless(v, loaded[k]) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return isinstance(loaded, list) and len(value) == len(loaded) and \
+            all(is_json_lossless(v, l) for v, l in zip(value, loaded))
+    if isinstance(value, string_types):
+        return isinstance(loaded, string_types) and value == loaded
+    if isinstance(value, bool) or value is None:
+        return value is loaded
+    if isinstance(value, integer_types + (float,)):
+        return not isinstance(loaded, bool) and isinstance(loaded, type(value)) and value == loaded
+
+    return False
+
+
+def to_lossless_json(value):
+    """Serializes a value to json, raising an exception if it can't be loaded again unchanged."""
+
+    serialized = json.dumps(value, separators=(",", ":"))
+    if not is_json_lossless(value, json.loads(serialized)):
+        raise ValueError("Value can't be serialized to json without changing it")
+    return serialized
+
+
+def is_private_path(path, st=None):
+    """Checks whether a file or folder is owned by the current user, and not writable by anybody else."""
+
+    if st is None:
+        st = os.stat(path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class RenderCache(object):
+    """Caches json-serializable values on disk, keyed by a hash of all inputs that were used to create them.
+
+    Least recently used entries are evicted once the total size of the cache exceeds 'max_size'.
+    As cached values can contain (user-provided) variables, the cache folder is only readable by
+    the current user. As they also contain the tasks that will be run, the cache is not used if
+    the folder or an entry is owned by somebody else, or writable by anybody else.
+
+    Args:
+      path (str): the cache folder
+      max_size (int): the maximum size of all cache entries, in bytes
+      metrics (RunMetrics): optional metrics object to record cache hits and misses in
+    """
+
+    def __init__(self, path=DEFAULT_RENDER_CACHE_PATH, max_size=DEFAULT_RENDER_CACHE_MAX_SIZE, metrics=None):
+
+        self.path = path
+        self.max_size = max_size
+        self.metrics = metrics
+
+    def create_key(self, *inputs):
+        """Calculates the cache key for the provided inputs.
+
+        All inputs are serialized (in order, and including the frecklecute version).
+
+        Returns:
+          str: the key, or None if the inputs can't be serialized to json without changing them (in which case they can't be cached)
+        """
+
+        try:
+            serialized = to_lossless_json([__version__] + list(inputs))
+        except (Exception) as e:
+            log.debug("Not caching, inputs can't be serialized: {}".format(e))
+            return None
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+
+        return os.path.join(self.path, "{}{}".format(key, RENDER_CACHE_FILE_EXTENSION))
+
+    def _record(self, name):
+
+        if self.metrics is not None:
+            self.metrics.inc(name, cache="rendered")
+
+    def _check_path(self):
+
+        try:
+            if is_private_path(self.path):
+                return True
+        except (OSError):
+            return False
+        log.warning("Not using render cache, '{}' is owned by a different user or writable by others.".format(self.path))
+        return False
+
+    def get(self, key):
+        """Returns the cached value for the key, or None if there is none."""
+
+        if not self._check_path():
+            self._record("cache_misses")
+            return None
+
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "r") as f:
+                if not is_private_path(entry, os.fstat(f.fileno())):
+                    log.warning("Not using render cache entry '{}', it is owned by a different user or writable by others.".format(entry))
+                    self._record("cache_misses")
+                    return None
+                obj = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, OSError):
+            self._record("cache_misses")
+            return None
+        except (Exception) as e:
+            log.debug("Removing invalid render cache entry '{}': {}".format(entry, e))
+            self._remove(entry)
+            self._record("cache_misses")
+            return None
+
+        # update the access time for the lru eviction
+        try:
+            os.utime(entry, None)
+        except (OSError):
+            pass
+
+        self._record("cache_hits")
+        return obj
+
+    def set(self, key, obj):
+        """Adds a value to the cache, evicting old entries if necessary.
+
+        Values that can't be serialized to json without changing them are not cached.
+        """
+
+        try:
+            serialized = to_lossless_json(obj)
+        except (Exception) as e:
+            log.debug("Not caching value: {}".format(e))
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        if not self._check_path():
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(serialized)
+            getattr(os, "replace", os.rename)(temp_path, self._entry_path(key))
+        except (Exception) as e:
+            log.debug("Could not write render cache entry: {}".format(e))
+            self._remove(temp_path)
+            return
+
+        self.evict()
+
+    def _remove(self, path):
+
+        try:
+            os.remove(path)
+        except (OSError):
+            pass
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within its size limit."""
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(RENDER_CACHE_FILE_EXTENSION):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry)
+            except (OSError):
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+            total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        for mtime, size, entry in sorted(entries):
+            log.debug("Evicting render cache entry: {}".format(entry))
+            self._remove(entry)
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+    def clear(self):
+        """Removes all cache entries."""
+
+        if not os.path.isdir(self.path):
+            return
+
+        for name in os.listdir(self.path):
+            if name.endswith(RENDER_CACHE_FILE_EXTENSION):
+                self._remove(os.path.join(self.path, name))
@@ -10,16 +10,19 @@ from collections import OrderedDict
 
 import click_completion
 import click_log
-import yaml
 from frkl import frkl
-from luci import JINJA_DELIMITER_PROFILES, ordered_load, replace_string
+from luci import ordered_load
 
 from freckles.freckles_base_cli import FrecklesBaseCommand, process_extra_task_lists
 from freckles.freckles_defaults import *
-from freckles.utils import DEFAULT_FRECKLES_CONFIG, freckles_jinja_extensions
+from freckles.utils import DEFAULT_FRECKLES_CONFIG
 from . import print_version
+from .cache import RenderCache
 from .frecklecute import Frecklecutable, Frecklecute
-from .utils import FrecklecutableFinder, FrecklecutableReader
+from .metrics import METRICS_FORMATS, RunMetrics
+from .roles import DEFAULT_ROLE_STORE_MAX_SIZE, RoleStore, get_local_role_repos, parse_role_specs
+from .utils import FrecklecutableFinder, FrecklecutableReader, read_frecklecutable_metadata, render_frecklecutable_templates
+from .validate import ValidationState, validate_frecklecutables
 
 log = logging.getLogger("freckles")
 click_log.basic_config(log)
@@ -30,10 +33,24 @@ click_completion.init()
 VARS_HELP = "variables to be used for templating, can be overridden by cli options if applicable"
 DEFAULTS_HELP = "default variables, can be used instead (or in addition) to user input via command-line parameters"
 KEEP_METADATA_HELP = "keep metadata in result directory, mostly useful for debugging"
+METRICS_FILE_HELP = "file to (atomically) write run performance metrics to, e.g. into a node exporter textfile collector directory"
+METRICS_FORMAT_HELP = "format of the metrics file"
+RENDER_CACHE_HELP = "whether to re-use previously rendered task lists for identical inputs (rendered task lists, including all variables, are stored unencrypted in the user's cache folder)"
+ROLE_STORE_HELP = "whether to link locally available additional roles from the shared role store into the generated environment"
+ROLE_STORE_MAX_SIZE_HELP = "maximum size of the shared role store (in MiB), least recently used roles are removed when it grows larger"
+PREFLIGHT_HELP = "probe all target hosts (resolved via the ssh configuration) before the run, and either drop unreachable ones, or fail; hosts behind a bastion (ProxyJump/ProxyCommand) are not probed, and results are re-used for a minute"
+PREFLIGHT_TIMEOUT_HELP = "timeout for probing a single host, in seconds"
+PREFLIGHT_BANNER_CHECK_HELP = "whether probed hosts need to send an ssh banner to be considered reachable"
+PREFETCH_HELP = "Adds the roles of all available frecklecutables to the shared role store."
+PREFETCH_SOURCE_HELP = "additional local folder to look for roles and role archives, can be used multiple times"
+VALIDATE_HELP = "Validates frecklecutables (all available ones, if no names are provided), without running them."
+VALIDATE_FORCE_HELP = "also validate frecklecutables that didn't change since their last successful validation"
+VALIDATE_JOBS_HELP = "number of frecklecutables to validate in parallel (default: number of cpus)"
 FRECKLECUTE_EPILOG_TEXT = "frecklecute is free and open source software and part of the 'freckles' project, for more information visit: https://docs.freckles.io"
 
 DEFAULT_FRECKLECUTABLES_PATH = os.path.join(os.path.dirname(__file__), "external", "frecklecutables")
 DEFAULT_USER_FRECKLECUTABLES_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "frecklecutables")
+DEFAULT_PROBE_TIMEOUT = 5.0
 
 
 class FrecklecuteCommand(FrecklesBaseCommand):
@@ -44,11 +61,112 @@ class FrecklecuteCommand(FrecklesBaseCommand):
         config = DEFAULT_FRECKLES_CONFIG
         config.add_repo(DEFAULT_FRECKLECUTABLES_PATH)
         config.add_user_repo(DEFAULT_USER_FRECKLECUTABLES_PATH)
+
+        metrics_file_option = click.Option(param_decls=["--metrics-file"], help=METRICS_FILE_HELP, required=False,
+                                           envvar="FRECKLECUTE_METRICS_FILE", type=click.Path(dir_okay=False))
+        metrics_format_option = click.Option(param_decls=["--metrics-format"], help=METRICS_FORMAT_HELP,
+                                             type=click.Choice(METRICS_FORMATS), default="openmetrics",
+                                             envvar="FRECKLECUTE_METRICS_FORMAT", show_default=True)
+        render_cache_option = click.Option(param_decls=["--render-cache/--no-render-cache"], help=RENDER_CACHE_HELP,
+                                           default=False, envvar="FRECKLECUTE_RENDER_CACHE", show_default=True)
+        role_store_option = click.Option(param_decls=["--role-store/--no-role-store"], help=ROLE_STORE_HELP,
+                                         default=False, envvar="FRECKLECUTE_ROLE_STORE", show_default=True)
+        role_store_max_size_option = click.Option(param_decls=["--role-store-max-size"], help=ROLE_STORE_MAX_SIZE_HELP,
+                                                  type=int, default=DEFAULT_ROLE_STORE_MAX_SIZE // (1024 * 1024),
+                                                  envvar="FRECKLECUTE_ROLE_STORE_MAX_SIZE", show_default=True)
+        preflight_option = click.Option(param_decls=["--preflight"], help=PREFLIGHT_HELP, type=click.Choice(["off", "drop", "fail"]),
+                                        default="off", envvar="FRECKLECUTE_PREFLIGHT", show_default=True)
+        preflight_timeout_option = click.Option(param_decls=["--preflight-timeout"], help=PREFLIGHT_TIMEOUT_HELP, type=float,
+                                                default=DEFAULT_PROBE_TIMEOUT, envvar="FRECKLECUTE_PREFLIGHT_TIMEOUT", show_default=True)
+        preflight_banner_check_option = click.Option(param_decls=["--preflight-banner-check/--no-preflight-banner-check"],
+                                                     help=PREFLIGHT_BANNER_CHECK_HELP, default=True,
+                                                     envvar="FRECKLECUTE_PREFLIGHT_BANNER_CHECK", show_default=True)
+        if extra_params is None:
+            extra_params = []
+        extra_params = [metrics_file_option, metrics_format_option, render_cache_option, role_store_option, role_store_max_size_option,
+                        preflight_option, preflight_timeout_option, preflight_banner_check_option] + list(extra_params)
+
+        self.metrics = RunMetrics()
+        self.render_cache = RenderCache(metrics=self.metrics)
+        self.dictlet_finder = None
+        self.internal_commands = OrderedDict()
+        self.internal_commands["prefetch"] = self.create_prefetch_command()
+        self.internal_commands["validate"] = self.create_validate_command()
         super(FrecklecuteCommand, self).__init__(config=config, extra_params=extra_params, print_version_callback=print_version, **kwargs)
 
+    def list_commands(self, ctx):
+
+        commands = super(FrecklecuteCommand, self).list_commands(ctx)
+        return list(self.internal_commands.keys()) + [c for c in commands if c not in self.internal_commands.keys()]
+
+    def get_command(self, ctx, name):
+
+        if name in self.internal_commands.keys():
+            # built-in commands take precedence over frecklecutables with the same name (files in the
+            # current directory are not considered, those can't be run by name anyway)
+            if name in self.get_dictlet_finder().get_all_dictlet_names():
+                log.warning("Frecklecutable '{}' is shadowed by the built-in '{}' command, it can't be run by name.".format(name, name))
+            return self.internal_commands[name]
+
+        return super(FrecklecuteCommand, self).get_command(ctx, name)
+
+    def get_role_store(self, parent_params, additional_repos=[]):
+
+        max_size = parent_params.get("role_store_max_size", None)
+        if max_size is None:
+            max_size = DEFAULT_ROLE_STORE_MAX_SIZE
+        else:
+            max_size = max_size * 1024 * 1024
+
+        return RoleStore(max_size=max_size, role_repos=get_local_role_repos(self.config) + list(additional_repos))
+
+    def create_prefetch_command(self):
+
+        def prefetch(source):
+
+            parent_params = click.get_current_context().parent.params
+            role_store = self.get_role_store(parent_params, additional_repos=source)
+
+            finder = self.get_dictlet_finder()
+            reader = self.get_dictlet_reader()
+
+            missing_roles = False
+            for name, details in finder.get_all_dictlets().items():
+                try:
+                    metadata = read_frecklecutable_metadata(details["path"], reader=reader)
+                except (Exception) as e:
+                    log.warning("Can't read frecklecutable '{}', ignoring it: {}".format(name, e))
+                    continue
+
+                roles = metadata.get("__freckles__", {}).get("roles", [])
+                if not roles:
+                    continue
+
+                click.secho("{}:".format(name), bold=True)
+                missing = [spec["name"] for spec in role_store.prefetch(roles)]
+                for spec in parse_role_specs(roles):
+                    if spec["name"] in missing:
+                        missing_roles = True
+                        click.echo("  - {}: not available locally".format(spec["name"]))
+                    else:
+                        click.echo("  - {}: stored".format(spec["name"]))
+
+            if missing_roles:
+                click.echo()
+                click.echo("Roles that are not available locally will be downloaded when a frecklecutable that uses them is run.")
+
+        return click.Command("prefetch", callback=prefetch, help=PREFETCH_HELP, params=[
+            click.Option(param_decls=["--source", "-s"], help=PREFETCH_SOURCE_HELP, multiple=True,
+                         type=click.Path(exists=True, file_okay=False))])
+
     def get_dictlet_finder(self):
 
-        return FrecklecutableFinder(self.paths)
+        # one finder per command, so its index is only built once
+        if self.dictlet_finder is None:
+            self.dictlet_finder = FrecklecutableFinder(self.paths, metrics=self.metrics)
+        else:
+            self.dictlet_finder.paths = self.paths
+        return self.dictlet_finder
 
     def get_dictlet_reader(self):
 
@@ -57,8 +175,64 @@ class FrecklecuteCommand(FrecklesBaseCommand):
     def get_additional_args(self):
         return {}
 
+    def create_validate_command(self):
+
+        def validate(names, force, jobs):
+
+            all_dictlets = self.get_dictlet_finder().get_all_dictlets()
+            if names:
+                dictlets = OrderedDict()
+                for name in names:
+                    if name not in all_dictlets.keys():
+                        raise click.ClickException("No frecklecutable '{}' found".format(name))
+                    dictlets[name] = all_dictlets[name]
+            else:
+                dictlets = all_dictlets
+
+            failed = 0
+            skipped = 0
+            for result in validate_frecklecutables(dictlets, processes=jobs, state=ValidationState(), force=force):
+                if result.get("skipped", False):
+                    skipped += 1
+                    log.debug("Skipping unchanged frecklecutable: {}".format(result["name"]))
+                    continue
+
+                click.echo("- {}: ".format(result["name"]), nl=False)
+                if result["errors"]:
+                    failed += 1
+                    click.secho("failed", fg="red", bold=True)
+                else:
+                    click.secho("ok", fg="green")
+                for error in result["errors"]:
+                    click.echo("    error: {}".format(error))
+                for warning in result["warnings"]:
+                    click.echo("    warning: {}".format(warning))
+
+            click.echo()
+            click.echo("{} frecklecutable(s) checked, {} failed, {} unchanged".format(len(dictlets) - skipped, failed, skipped))
+            if failed:
+                click.get_current_context().exit(1)
+
+        return click.Command("validate", callback=validate, help=VALIDATE_HELP, params=[
+            click.Argument(param_decls=["names"], nargs=-1, required=False),
+            click.Option(param_decls=["--force", "-f"], help=VALIDATE_FORCE_HELP, is_flag=True, default=False),
+            click.Option(param_decls=["--jobs", "-j"], help=VALIDATE_JOBS_HELP, type=int, default=None)])
+
     def freckles_process(self, command_name, default_vars, extra_vars, user_input, metadata, dictlet_details, config, parent_params, command_var_spec):
 
+        metrics_file = parent_params.get("metrics_file", None)
+        metrics_format = parent_params.get("metrics_format", "openmetrics")
+
+        try:
+            self.process_frecklecutable(command_name, default_vars, extra_vars, user_input, metadata, dictlet_details, parent_params, command_var_spec)
+        finally:
+            if metrics_file:
+                try:
+                    self.metrics.write(metrics_file, metrics_format=metrics_format)
+                except (Exception) as e:
+                    log.warning("Could not write metrics file '{}': {}".format(metrics_file, e))
+
+    def process_frecklecutable(self, command_name, default_vars, extra_vars, user_input, metadata, dictlet_details, parent_params, command_var_spec):
 
         all_vars = OrderedDict()
         frkl.dict_merge(all_vars, default_vars, copy_dct=False)
@@ -71,39 +245,31 @@ class FrecklecuteCommand(FrecklesBaseCommand):
         password_type = parent_params.get("password", None)
         no_run = parent_params.get("no_run", False)
 
-        tasks_string = metadata.get(FX_TASKS_KEY_NAME, "")
-        vars_string = metadata.get(FX_VARS_KEY_NAME, "")
-
-        replaced_vars = replace_string(vars_string, all_vars, additional_jinja_extensions=freckles_jinja_extensions, **JINJA_DELIMITER_PROFILES["luci"])
-        try:
-            vars_dictlet = yaml.safe_load(replaced_vars)
-        except (Exception) as e:
-            raise Exception("Can't parse vars: {}".format(e))
-
-        if vars_dictlet:
-            temp_new_all_vars = frkl.dict_merge(all_vars, vars_dictlet, copy_dct=True)
-        else:
-            temp_new_all_vars = all_vars
-
-        replaced_tasks = replace_string(tasks_string, temp_new_all_vars, additional_jinja_extensions=freckles_jinja_extensions, **JINJA_DELIMITER_PROFILES["luci"])
-        try:
-            tasks_list_temp = ordered_load(replaced_tasks)
-        except (Exception) as e:
-            raise click.ClickException("Could not parse frecklecutable '{}': {}".format(command_name, e))
+        use_render_cache = parent_params.get("render_cache", False)
 
         extra_task_lists_map = process_extra_task_lists(metadata, dictlet_details["path"])
 
-        # check for hardcoded task_list_format:
-        task_list_format = metadata.get("__freckles__", {}).get("task_list_format", None)
-
-        additional_roles = metadata.get("__freckles__", {}).get("roles", [])
-
-        result_vars = {}
-        for name, details in command_var_spec.items():
-            if name in temp_new_all_vars and details.get("is_var", False) == True:
-                result_vars[name] = temp_new_all_vars[name]
-
-        f = Frecklecutable(command_name, replaced_tasks, result_vars, tasks_format=task_list_format, external_task_list_map=extra_task_lists_map, additional_roles=additional_roles)
+        # only the constructor arguments of the Frecklecutable are cached, and only if they (and all
+        # inputs) can be stored as json without changing them
+        f_args = None
+        cache_key = None
+        if use_render_cache:
+            cache_key = self.render_cache.create_key(
+                command_name, metadata.get(FX_TASKS_KEY_NAME, ""), metadata.get(FX_VARS_KEY_NAME, ""),
+                metadata.get("__freckles__", {}), all_vars, command_var_spec, extra_task_lists_map, list(hosts))
+            if cache_key is not None:
+                f_args = self.render_cache.get(cache_key)
+
+        if f_args is None:
+            f_args = self.render_frecklecutable(command_name, all_vars, metadata, extra_task_lists_map, command_var_spec)
+            f = Frecklecutable(**f_args)
+            if cache_key is not None:
+                # saves guessing the task-list format next time
+                f_args["tasks_format"] = f.tasks_format
+                self.render_cache.set(cache_key, f_args)
+        else:
+            log.debug("Using cached rendered frecklecutable for '{}'".format(command_name))
+            f = Frecklecutable(**f_args)
 
         # placeholder, for maybe later
         task_metadata = {}
@@ -125,9 +291,54 @@ class FrecklecuteCommand(FrecklesBaseCommand):
         else:
             raise Exception("Can't process password: {}".format(password_type))
 
-        run = Frecklecute(f, config=self.config, ask_become_pass=password_type, password=password)
+        if parent_params.get("role_store", False):
+            role_store = self.get_role_store(parent_params)
+        else:
+            role_store = None
+
+        preflight = parent_params.get("preflight", "off")
+        if preflight != "off":
+            # asyncio is not available on Python 2
+            from .preflight import DEFAULT_PROBE_CACHE_PATH, HostProber
+            # every invocation creates a new prober, results are shared between invocations via the cache file
+            host_prober = HostProber(timeout=parent_params.get("preflight_timeout", DEFAULT_PROBE_TIMEOUT),
+                                     check_banner=parent_params.get("preflight_banner_check", True),
+                                     cache_path=DEFAULT_PROBE_CACHE_PATH)
+            unreachable_hosts = preflight
+        else:
+            host_prober = None
+            unreachable_hosts = "drop"
+
+        run = Frecklecute(f, config=self.config, ask_become_pass=password_type, password=password, metrics=self.metrics, role_store=role_store,
+                          host_prober=host_prober, unreachable_hosts=unreachable_hosts)
         run.execute(hosts=hosts, no_run=no_run, output_format=output_format)
 
+    def render_frecklecutable(self, command_name, all_vars, metadata, extra_task_lists_map, command_var_spec):
+        """Renders the templates of a frecklecutable.
+
+        Returns:
+          dict: the arguments to create the resulting Frecklecutable object with
+        """
+
+        replaced_tasks, temp_new_all_vars = render_frecklecutable_templates(command_name, metadata, all_vars, metrics=self.metrics)
+        try:
+            tasks_list_temp = ordered_load(replaced_tasks)
+        except (Exception) as e:
+            raise click.ClickException("Could not parse frecklecutable '{}': {}".format(command_name, e))
+
+        # check for hardcoded task_list_format:
+        task_list_format = metadata.get("__freckles__", {}).get("task_list_format", None)
+
+        additional_roles = metadata.get("__freckles__", {}).get("roles", [])
+
+        result_vars = {}
+        for name, details in command_var_spec.items():
+            if name in temp_new_all_vars and details.get("is_var", False) == True:
+                result_vars[name] = temp_new_all_vars[name]
+
+        return {"name": command_name, "tasks": replaced_tasks, "vars": result_vars, "tasks_format": task_list_format,
+                "external_task_list_map": extra_task_lists_map, "additional_roles": additional_roles}
+
 @click.command(name="frecklecute", cls=FrecklecuteCommand, epilog=FRECKLECUTE_EPILOG_TEXT, subcommand_metavar="FRECKLECUTEABLE")
 @click_log.simple_verbosity_option(log, "--verbosity")
 @click.pass_context
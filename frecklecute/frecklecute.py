@@ -4,6 +4,7 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 from collections import OrderedDict
+from timeit import default_timer
 
 import yaml
 from frkl import frkl
@@ -12,6 +13,8 @@ from six import string_types
 from freckles.freckles_base_cli import create_external_task_list_callback, get_task_list_format
 from freckles.freckles_defaults import *
 from freckles.utils import create_and_run_nsbl_runner
+from .metrics import RunMetrics
+from .roles import role_spec_to_nsbl
 from .utils import print_task_list_details
 
 log = logging.getLogger("freckles")
@@ -95,13 +98,28 @@ class Frecklecute(object):
 
     This basically wraps an Ansible playbook run, including the generationn of an Ansible
     environment folder structure, auto-download/use of required roles, etc.
+
+    Timings and task counts of every run are recorded in the 'metrics' attribute (a
+    :class:`~frecklecute.metrics.RunMetrics` object), which can be provided to share it with
+    other components.
+
+    If a :class:`~frecklecute.roles.RoleStore` is provided, additional roles that can be found
+    locally are linked into the generated environment from there, instead of being handled by nsbl.
+
+    If a :class:`~frecklecute.preflight.HostProber` is provided, all target hosts are probed
+    before anything is rendered. Unreachable hosts are either dropped from the run, or make it
+    fail (depending on 'unreachable_hosts', either 'drop' or 'fail').
     """
 
     def __init__(self,
                  frecklecutables,
                  config=None,
                  ask_become_pass=False,
-                 password=None):
+                 password=None,
+                 metrics=None,
+                 role_store=None,
+                 host_prober=None,
+                 unreachable_hosts="drop"):
 
         if not isinstance(frecklecutables, (list, tuple)):
             frecklecutables = [frecklecutables]
@@ -112,17 +130,87 @@ class Frecklecute(object):
         self.config = config
         self.ask_become_pass = ask_become_pass
         self.password = password
+        if metrics is None:
+            metrics = RunMetrics()
+        self.metrics = metrics
+        self.role_store = role_store
+        self.host_prober = host_prober
+        if unreachable_hosts not in ["drop", "fail"]:
+            raise Exception("Invalid value for 'unreachable_hosts': {}".format(unreachable_hosts))
+        self.unreachable_hosts = unreachable_hosts
+
+    def filter_reachable_hosts(self, probe_results):
+        """Reports unreachable hosts, and returns the reachable ones.
+
+        Args:
+          probe_results (list): the results of the pre-flight host probes
+
+        Returns:
+          list: the names of all reachable hosts
+        """
+
+        reachable = [r.host for r in probe_results if r.reachable]
+        unreachable = [r for r in probe_results if not r.reachable]
+
+        self.metrics.set("preflight_hosts", len(reachable), status="reachable")
+        self.metrics.set("preflight_hosts", len(unreachable), status="unreachable")
+
+        for r in unreachable:
+            log.warning("Host '{}' is not reachable: {}".format(r.host, r.error))
+
+        if unreachable and self.unreachable_hosts == "fail":
+            raise Exception("Unreachable host(s): {}".format(", ".join(r.host for r in unreachable)))
+        if not reachable:
+            raise Exception("None of the target hosts is reachable.")
+
+        return reachable
 
     def execute(self,
                 hosts=["localhost"],
                 no_run=False,
                 output_format="default"):
 
+        if self.host_prober is not None:
+            with self.metrics.timer("preflight_duration_seconds"):
+                probe_results = self.host_prober.check_hosts(hosts)
+            hosts = self.filter_reachable_hosts(probe_results)
+
         results = []
         for f in self.frecklecutables.keys():
             r = self.start_frecklecute_run(
                 f, hosts=hosts, no_run=no_run, output_format=output_format)
 
+    def prepare_run_callback(self, f):
+        """Creates the callback that finishes the generated environment of a frecklecutable before it is run.
+
+        Returns:
+          tuple: the callback, and the additional roles that still need to be handled by nsbl
+        """
+
+        tasks_callback_map = [{
+            "tasks": f.tasks,
+            "tasks_string": f.tasks_string,
+            "tasks_format": f.tasks_format,
+            "target_name": "frecklecutable_default_tasks.yml"
+        }]
+
+        callback = create_external_task_list_callback(f.external_task_list_map,
+                                                      tasks_callback_map)
+
+        if self.role_store is None or not f.additional_roles:
+            return (callback, f.additional_roles)
+
+        stored_roles, missing = self.role_store.checkout(f.additional_roles)
+        additional_roles = [role_spec_to_nsbl(spec) for spec in missing]
+        if not stored_roles:
+            return (callback, additional_roles)
+
+        def link_roles_callback(env_dir):
+            self.role_store.link_roles(stored_roles, os.path.join(env_dir, "roles", "external"))
+            callback(env_dir)
+
+        return (link_roles_callback, additional_roles)
+
     def start_frecklecute_run(self,
                               frecklecutable,
                               hosts=["localhost"],
@@ -134,28 +222,25 @@ class Frecklecute(object):
             raise Exception(
                 "No frecklecutable '{}' found".format(frecklecutable))
 
-        tasks_callback_map = [{
-            "tasks": f.tasks,
-            "tasks_string": f.tasks_string,
-            "tasks_format": f.tasks_format,
-            "target_name": "frecklecutable_default_tasks.yml"
-        }]
+        start = default_timer()
+        self.metrics.set("tasks", len(f.tasks), frecklecutable=f.name, status="planned")
 
-        callback = create_external_task_list_callback(f.external_task_list_map,
-                                                      tasks_callback_map)
+        with self.metrics.timer("run_duration_seconds", frecklecutable=f.name, phase="prepare"):
+            callback, additional_roles = self.prepare_run_callback(f)
 
         if no_run:
-            parameters = create_and_run_nsbl_runner(
-                f.task_config,
-                task_metadata=f.task_metadata,
-                output_format=output_format,
-                pre_run_callback=callback,
-                ask_become_pass=self.ask_become_pass,
-                password=self.password,
-                no_run=True,
-                config=self.config,
-                hosts_list=hosts,
-                additional_roles=f.additional_roles)
+            with self.metrics.timer("run_duration_seconds", frecklecutable=f.name, phase="render"):
+                parameters = create_and_run_nsbl_runner(
+                    f.task_config,
+                    task_metadata=f.task_metadata,
+                    output_format=output_format,
+                    pre_run_callback=callback,
+                    ask_become_pass=self.ask_become_pass,
+                    password=self.password,
+                    no_run=True,
+                    config=self.config,
+                    hosts_list=hosts,
+                    additional_roles=additional_roles)
             print_task_list_details(
                 f.task_config,
                 task_metadata=f.metadata,
@@ -164,18 +249,28 @@ class Frecklecute(object):
                 run_parameters=parameters)
             result = None
         else:
-            result = create_and_run_nsbl_runner(
-                f.task_config,
-                task_metadata=f.metadata,
-                output_format=output_format,
-                pre_run_callback=callback,
-                ask_become_pass=self.ask_become_pass,
-                password=self.password,
-                config=self.config,
-                run_box_basics=True,
-                hosts_list=hosts,
-                additional_roles=f.additional_roles)
+            with self.metrics.timer("run_duration_seconds", frecklecutable=f.name, phase="execute"):
+                result = create_and_run_nsbl_runner(
+                    f.task_config,
+                    task_metadata=f.metadata,
+                    output_format=output_format,
+                    pre_run_callback=callback,
+                    ask_become_pass=self.ask_become_pass,
+                    password=self.password,
+                    config=self.config,
+                    run_box_basics=True,
+                    hosts_list=hosts,
+                    additional_roles=additional_roles)
 
             click.echo()
 
+            # the runner only reports an overall result, not the status of every single task, so
+            # only the run itself gets a status here
+            return_code = result.get("return_code", None) if isinstance(result, dict) else None
+            if return_code is not None:
+                self.metrics.set("run_return_code", return_code, frecklecutable=f.name)
+                self.metrics.set_run_status(f.name, return_code)
+
+        self.metrics.inc("run_duration_seconds", default_timer() - start, frecklecutable=f.name, phase="total")
+
         return result
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Collection and export of frecklecute run performance metrics."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from timeit import default_timer
+
+log = logging.getLogger("freckles")
+
+METRICS_FORMATS = ["openmetrics", "json"]
+RUN_STATUSES = ["succeeded", "failed"]
+DEFAULT_METRICS_PREFIX = "frecklecute"
+
+# name -> (type, help)
+METRIC_DESCRIPTIONS = OrderedDict([
+    ("run_duration_seconds", ("gauge", "Time spent per frecklecutable and run phase.")),
+    ("run_return_code", ("gauge", "Return code of the last run of a frecklecutable.")),
+    ("run_status", ("gauge", "Status of the last run of a frecklecutable (1 for the current status, 0 otherwise).")),
+    ("tasks", ("gauge", "Number of tasks per frecklecutable, by status.")),
+    ("discovery_duration_seconds", ("gauge", "Time spent discovering frecklecutables.")),
+    ("discovery_files_scanned", ("gauge", "Number of files looked at while discovering frecklecutables.")),
+    ("template_render_duration_seconds", ("gauge", "Time spent rendering frecklecutable templates.")),
+    ("cache_hits", ("gauge", "Number of cache hits, by cache.")),
+    ("cache_misses", ("gauge", "Number of cache misses, by cache.")),
+    ("preflight_duration_seconds", ("gauge", "Time spent probing target hosts before a run.")),
+    ("preflight_hosts", ("gauge", "Number of probed target hosts, by reachability.")),
+    ("last_run_timestamp_seconds", ("gauge", "Unix time the metrics were written.")),
+])
+
+
+def escape_label_value(value):
+    """Escapes a label value according to the OpenMetrics text format."""
+
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric_value(value):
+
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class RunMetrics(object):
+    """Collects performance metrics of a frecklecute invocation.
+
+    All values are gauges describing the current process, which matches how textfiles
+    for the node exporter are usually written (one file per job, overwritten on every run).
+
+    Args:
+      prefix (str): the prefix to use for all metric names
+    """
+
+    def __init__(self, prefix=DEFAULT_METRICS_PREFIX):
+
+        self.prefix = prefix
+        self.values = OrderedDict()
+
+    def _get_metric(self, name):
+
+        if name not in METRIC_DESCRIPTIONS.keys():
+            raise Exception("Unknown metric: {}".format(name))
+
+        return self.values.setdefault(name, OrderedDict())
+
+    def set(self, name, value, **labels):
+        """Sets a metric to a value."""
+
+        metric = self._get_metric(name)
+        metric[tuple(sorted(labels.items()))] = value
+
+    def inc(self, name, amount=1, **labels):
+        """Increases a metric by the provided amount."""
+
+        metric = self._get_metric(name)
+        key = tuple(sorted(labels.items()))
+        metric[key] = metric.get(key, 0) + amount
+
+    def get(self, name, **labels):
+        """Returns the current value of a metric, or None if it was never recorded."""
+
+        return self.values.get(name, {}).get(tuple(sorted(labels.items())), None)
+
+    def set_run_status(self, frecklecutable, return_code):
+        """Sets the 'run_status' metric of a frecklecutable, depending on the return code of its run."""
+
+        current = "succeeded" if return_code == 0 else "failed"
+        for status in RUN_STATUSES:
+            self.set("run_status", 1 if status == current else 0, frecklecutable=frecklecutable, status=status)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Context manager that adds the time spent within it to a metric."""
+
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.inc(name, default_timer() - start, **labels)
+
+    def to_dict(self):
+        """Returns all recorded metrics as a (json-serializable) dict."""
+
+        result = OrderedDict()
+        for name, samples in self.values.items():
+            metric_type, help_text = METRIC_DESCRIPTIONS[name]
+            result[name] = {
+                "type": metric_type,
+                "help": help_text,
+                "samples": [{"labels": OrderedDict(key), "value": value} for key, value in samples.items()]
+            }
+        return result
+
+    def to_json(self):
+
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_openmetrics(self):
+        """Renders all recorded metrics in the OpenMetrics text exposition format."""
+
+        lines = []
+        for name, samples in self.values.items():
+            metric_type, help_text = METRIC_DESCRIPTIONS[name]
+            full_name = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(full_name, help_text))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for key, value in samples.items():
+                if key:
+                    labels = ",".join("{}=\"{}\"".format(k, escape_label_value(v)) for k, v in key)
+                    lines.append("{}{{{}}} {}".format(full_name, labels, format_metric_value(value)))
+                else:
+                    lines.append("{} {}".format(full_name, format_metric_value(value)))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, metrics_format="openmetrics"):
+        """Atomically writes all recorded metrics to a file.
+
+        The content is written to a temporary file in the same directory first, which is then
+        renamed, so a scraper never sees a partially written file.
+
+        Args:
+          path (str): the target file
+          metrics_format (str): either 'openmetrics' or 'json'
+        """
+
+        self.set("last_run_timestamp_seconds", time.time())
+
+        if metrics_format == "openmetrics":
+            content = self.to_openmetrics()
+        elif metrics_format == "json":
+            content = self.to_json()
+        else:
+            raise Exception("Invalid metrics format: {}".format(metrics_format))
+
+        path = os.path.abspath(os.path.expanduser(path))
+        target_dir = os.path.dirname(path)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        fd, temp_path = tempfile.mkstemp(dir=target_dir, prefix=".{}.".format(os.path.basename(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_path, 0o644)
+            # os.replace is not available on Python 2, rename is atomic on posix
+            getattr(os, "replace", os.rename)(temp_path, path)
+        except (Exception):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        log.debug("Wrote metrics to: {}".format(path))
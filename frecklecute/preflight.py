@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrent pre-flight reachability checks of target hosts.
+
+This module requires Python 3.5 or newer.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from timeit import default_timer
+
+from .cache import is_private_path
+
+log = logging.getLogger("freckles")
+
+DEFAULT_PROBE_TIMEOUT = 5.0
+DEFAULT_PROBE_CONCURRENCY = 64
+DEFAULT_PROBE_CACHE_TTL = 60.0
+DEFAULT_PROBE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "cache", "frecklecute", "preflight.json")
+DEFAULT_SSH_PORT = 22
+LOCAL_HOSTS = ["localhost", "127.0.0.1", "::1"]
+
+
+def parse_host(host):
+    """Parses a host string of the format '[user@]hostname[:port]' (IPv6 addresses need to be in brackets if a port is provided).
+
+    Returns:
+      tuple: the hostname and port (None if not specified)
+    """
+
+    if "@" in host:
+        host = host.split("@", 1)[1]
+
+    if host.startswith("["):
+        hostname, _, rest = host[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else None
+    elif host.count(":") == 1:
+        hostname, port = host.split(":")
+    else:
+        hostname, port = host, None
+
+    if port is not None:
+        try:
+            port = int(port)
+        except (ValueError):
+            raise Exception("Invalid port in host '{}': {}".format(host, port))
+
+    return (hostname, port)
+
+
+class ProbeResult(object):
+    """The result of probing a single host."""
+
+    __slots__ = ("host", "reachable", "method", "error", "duration", "timestamp")
+
+    def __init__(self, host, reachable, method, error=None, duration=0.0, timestamp=None):
+
+        self.host = host
+        self.reachable = reachable
+        self.method = method
+        self.error = error
+        self.duration = duration
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+    def to_dict(self):
+
+        return dict((k, getattr(self, k)) for k in ProbeResult.__slots__)
+
+    @classmethod
+    def from_dict(cls, details):
+
+        return cls(**details)
+
+    def __repr__(self):
+
+        return "ProbeResult(host={!r}, reachable={!r}, method={!r}, error={!r})".format(
+            self.host, self.reachable, self.method, self.error)
+
+
+class HostProber(object):
+    """Probes target hosts concurrently, before a run is started.
+
+    Local hosts (without an explicit port) are always considered reachable, as they use a local
+    connection. All other hosts are resolved the way ssh (and so Ansible) would connect to them,
+    using the ssh configuration ('ssh -G'), so 'HostName' and 'Port' settings are honoured (a port in
+    the host string overrides the configured one, like the inventory port does in Ansible). If the
+    ssh client is not available, the host string and the default port are used as they are.
+
+    Hosts that are reached via a bastion ('ProxyJump' or 'ProxyCommand') can't be probed directly,
+    they are always considered reachable (with the method 'skipped'). For all other hosts a TCP
+    connection to the ssh port is opened, and optionally the SSH banner is checked (this needs to be
+    disabled for targets that don't send one, e.g. because of a port knocking or multiplexing
+    setup). At most 'concurrency' hosts are probed at the same time.
+
+    Results are cached for 'cache_ttl' seconds. The cache is kept in memory (so it only helps
+    long-running processes that re-use one prober), unless 'cache_path' is provided, in which case
+    results are also shared with other processes (e.g. consecutive command-line runs) via that file.
+    Either way, a host that comes up (or goes down) within that time is reported in its previous state.
+
+    Args:
+      timeout (float): the timeout for probing a single host, in seconds
+      concurrency (int): the maximum number of concurrent probes
+      check_banner (bool): whether to check that the remote port sends an SSH banner
+      cache_ttl (float): how long to re-use probe results, in seconds
+      port (int): the port to use for hosts that don't specify one, and have none configured
+      cache_path (str): optional file to persist probe results in
+      ssh_config (str): optional ssh configuration file to use instead of the default one
+    """
+
+    def __init__(self, timeout=DEFAULT_PROBE_TIMEOUT, concurrency=DEFAULT_PROBE_CONCURRENCY, check_banner=True,
+                 cache_ttl=DEFAULT_PROBE_CACHE_TTL, port=DEFAULT_SSH_PORT, cache_path=None, ssh_config=None):
+
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.check_banner = check_banner
+        self.cache_ttl = cache_ttl
+        self.port = port
+        self.cache_path = cache_path
+        self.ssh_config = ssh_config
+        self.cache = {}
+
+    def _cache_key(self, host):
+
+        # results depend on how the host was probed
+        return json.dumps([host, self.port, self.check_banner, self.ssh_config])
+
+    def _is_expired(self, result):
+
+        return time.time() - result.timestamp > self.cache_ttl
+
+    def _get_cached(self, host):
+
+        key = self._cache_key(host)
+        result = self.cache.get(key, None)
+        if result is None:
+            return None
+        if self._is_expired(result):
+            del self.cache[key]
+            return None
+        return result
+
+    def _set_cached(self, result):
+
+        self.cache[self._cache_key(result.host)] = result
+
+    def load_cache(self):
+        """Adds the (unexpired) results of the cache file to the in-memory cache."""
+
+        if self.cache_path is None:
+            return
+
+        try:
+            with open(self.cache_path, "r") as f:
+                if not is_private_path(self.cache_path, os.fstat(f.fileno())):
+                    log.warning("Not using pre-flight cache '{}', it is owned by a different user or writable by others.".format(self.cache_path))
+                    return
+                entries = json.load(f)
+            results = dict((key, ProbeResult.from_dict(details)) for key, details in entries.items())
+        except (IOError, OSError):
+            return
+        except (Exception) as e:
+            log.debug("Ignoring invalid pre-flight cache '{}': {}".format(self.cache_path, e))
+            return
+
+        for key, result in results.items():
+            if key not in self.cache.keys() and not self._is_expired(result):
+                self.cache[key] = result
+
+    def save_cache(self):
+        """Writes all unexpired results to the cache file."""
+
+        if self.cache_path is None:
+            return
+
+        entries = dict((key, result.to_dict()) for key, result in self.cache.items() if not self._is_expired(result))
+        target_dir = os.path.dirname(self.cache_path)
+        try:
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir, 0o700)
+            fd, temp_path = tempfile.mkstemp(dir=target_dir, prefix=".preflight.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            getattr(os, "replace", os.rename)(temp_path, self.cache_path)
+        except (Exception) as e:
+            log.debug("Could not write pre-flight cache '{}': {}".format(self.cache_path, e))
+
+    async def resolve_ssh_target(self, hostname, port):
+        """Resolves the address, port and proxy ssh would use to connect to a host.
+
+        Returns:
+          tuple: the hostname, the port, and the configured 'ProxyJump' or 'ProxyCommand' (None if there is none)
+        """
+
+        command = ["ssh", "-G"]
+        if self.ssh_config is not None:
+            command.extend(["-F", self.ssh_config])
+        if port is not None:
+            command.extend(["-p", str(port)])
+        command.extend(["--", hostname])
+
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except (OSError) as e:
+            log.debug("Can't run ssh to resolve host '{}', using it as is: {}".format(hostname, e))
+            return (hostname, port or self.port, None)
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # the probe timed out
+            if process.returncode is None:
+                process.kill()
+            raise
+        if process.returncode != 0:
+            log.debug("Can't resolve host '{}' via ssh, using it as is: {}".format(hostname, stderr.decode("utf-8", errors="replace").strip()))
+            return (hostname, port or self.port, None)
+
+        config = {}
+        for line in stdout.decode("utf-8", errors="replace").splitlines():
+            key, _, value = line.partition(" ")
+            config[key.lower()] = value.strip()
+
+        proxy = None
+        for key in ["proxyjump", "proxycommand"]:
+            if config.get(key, "none").lower() != "none":
+                proxy = config[key]
+                break
+
+        try:
+            resolved_port = int(config["port"])
+        except (KeyError, ValueError):
+            resolved_port = port or self.port
+
+        return (config.get("hostname", hostname), resolved_port, proxy)
+
+    async def _probe_tcp(self, host, hostname, port):
+
+        reader, writer = await asyncio.open_connection(hostname, port)
+        try:
+            if self.check_banner:
+                banner = await reader.readline()
+                if not banner.startswith(b"SSH-"):
+                    return ProbeResult(host, False, "ssh", error="no ssh banner received on port {}".format(port))
+                return ProbeResult(host, True, "ssh")
+            return ProbeResult(host, True, "tcp")
+        finally:
+            writer.close()
+
+    async def _probe(self, host, hostname, port):
+
+        hostname, port, proxy = await self.resolve_ssh_target(hostname, port)
+        if proxy is not None:
+            log.info("Not probing host '{}', it is reached via a proxy: {}".format(host, proxy))
+            return ProbeResult(host, True, "skipped")
+
+        return await self._probe_tcp(host, hostname, port)
+
+    async def probe_host(self, host, semaphore=None):
+        """Probes a single host.
+
+        Returns:
+          ProbeResult: the result
+        """
+
+        cached = self._get_cached(host)
+        if cached is not None:
+            return cached
+
+        try:
+            hostname, port = parse_host(host)
+        except (Exception) as e:
+            result = ProbeResult(host, False, "parse", error=str(e))
+            self._set_cached(result)
+            return result
+
+        if port is None and hostname in LOCAL_HOSTS:
+            result = ProbeResult(host, True, "local")
+            self._set_cached(result)
+            return result
+
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(1)
+
+        async with semaphore:
+            start = default_timer()
+            try:
+                result = await asyncio.wait_for(self._probe(host, hostname, port), self.timeout)
+            except asyncio.TimeoutError:
+                result = ProbeResult(host, False, "tcp", error="timed out after {} seconds".format(self.timeout))
+            except (OSError) as e:
+                result = ProbeResult(host, False, "tcp", error=str(e))
+            result.duration = default_timer() - start
+
+        log.debug("Probed host '{}': {}".format(host, result))
+        self._set_cached(result)
+        return result
+
+    async def probe_hosts(self, hosts):
+        """Probes all hosts concurrently.
+
+        Returns:
+          list: a ProbeResult for every host, in the order of the hosts
+        """
+
+        self.load_cache()
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[self.probe_host(host, semaphore=semaphore) for host in hosts],
+                                       return_exceptions=True)
+
+        # an unexpected error while probing one host doesn't abort the other probes
+        for i, result in enumerate(results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                log.debug("Error probing host '{}': {}".format(hosts[i], result), exc_info=result)
+                results[i] = ProbeResult(hosts[i], False, "tcp", error=str(result))
+
+        self.save_cache()
+
+        return results
+
+    def check_hosts(self, hosts):
+        """Synchronous version of 'probe_hosts', runs the probes in a new event loop."""
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.probe_hosts(hosts))
+        finally:
+            loop.close()
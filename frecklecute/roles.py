@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+
+"""Shared, content-addressed local store for Ansible roles used by frecklecutables."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from nsbl import tasks as nsbl_tasks
+from six import string_types
+
+from freckles.freckles_defaults import DEFAULT_ABBREVIATIONS, DEFAULT_EXCLUDE_DIRS, DEFAULT_LOCAL_REPO_PATH_BASE, DEFAULT_REPOS
+
+try:
+    import fcntl
+except (ImportError):
+    # not available on Windows, the store is not locked there
+    fcntl = None
+
+log = logging.getLogger("freckles")
+
+DEFAULT_ROLE_STORE_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "cache", "frecklecute", "roles")
+DEFAULT_ROLE_STORE_MAX_SIZE = 500 * 1024 * 1024
+ROLE_ARCHIVE_EXTENSIONS = [".tar.gz", ".tgz", ".tar", ".zip"]
+ROLE_MARKER_DIRS = ["tasks", "meta"]
+ROLE_REPO_MARKER_FILE = os.path.join("meta", "main.yml")
+ROLE_STORE_INDEX_FILE = "index.json"
+ROLE_STORE_LOCK_FILE = "index.lock"
+# how long to remember that a role can't be found locally
+DEFAULT_MISSING_ROLE_TTL = 60 * 60
+# roles used within this time are never evicted, as they might still be used by a running run
+DEFAULT_ROLE_STORE_MIN_AGE = 60 * 60
+
+
+def parse_role_specs(roles):
+    """Parses the 'roles' value of a frecklecutable's '__freckles__' metadata.
+
+    Supports the same formats nsbl does: a role name or path string, a dict with 'name' (and optionally
+    'src' and 'version') keys, a dict with role names as keys, or a list of any of those.
+
+    Returns:
+      list: a list of dicts with 'name', 'src' and 'version' keys
+    """
+
+    result = []
+    if not roles:
+        return result
+
+    if isinstance(roles, string_types):
+        result.append({"name": os.path.basename(roles.rstrip(os.sep)), "src": roles, "version": None})
+    elif isinstance(roles, dict):
+        if "name" in roles.keys() or "src" in roles.keys():
+            src = roles.get("src", None)
+            name = roles.get("name", None)
+            if name is None:
+                name = os.path.basename(src.rstrip(os.sep))
+            result.append({"name": name, "src": src, "version": roles.get("version", None)})
+        else:
+            for name, details in roles.items():
+                if isinstance(details, string_types):
+                    result.append({"name": name, "src": details, "version": None})
+                elif isinstance(details, dict):
+                    result.append({"name": name, "src": details.get("src", None), "version": details.get("version", None)})
+                else:
+                    raise Exception("Role description needs to be either string or dict: {}".format(details))
+    elif isinstance(roles, (list, tuple)):
+        for r in roles:
+            result.extend(parse_role_specs(r))
+    else:
+        raise Exception("Invalid role description: {}".format(roles))
+
+    return result
+
+
+def role_spec_to_nsbl(spec):
+    """Converts a parsed role spec back into the format nsbl expects for 'additional_roles'."""
+
+    if not spec["version"] and (not spec["src"] or spec["src"] == spec["name"] or os.path.exists(spec["src"])):
+        return spec["src"] or spec["name"]
+
+    return dict((k, v) for k, v in spec.items() if v)
+
+
+def is_role_dir(path):
+
+    return os.path.isdir(path) and any(os.path.isdir(os.path.join(path, d)) for d in ROLE_MARKER_DIRS)
+
+
+def is_role_archive(path):
+
+    return os.path.isfile(path) and any(path.endswith(ext) for ext in ROLE_ARCHIVE_EXTENSIONS)
+
+
+def get_local_role_repos(config):
+    """Returns the local role repositories of the trusted repos of a freckles configuration, the same way nsbl resolves them."""
+
+    return nsbl_tasks.get_local_repos(config.trusted_repos, "roles", DEFAULT_LOCAL_REPO_PATH_BASE, DEFAULT_REPOS,
+                                      DEFAULT_ABBREVIATIONS)
+
+
+def is_repo_role_dir(path):
+    """Checks whether a folder in a role repository is a role, using the same marker as nsbl ('meta/main.yml')."""
+
+    return os.path.isfile(os.path.join(path, ROLE_REPO_MARKER_FILE))
+
+
+def index_local_roles(role_repos, exclude_dirs=DEFAULT_EXCLUDE_DIRS):
+    """Walks a list of role repositories once, and collects all roles (folders or archives) in them.
+
+    Repos later in the list have higher priority. Folders within roles, hidden folders, folders in
+    'exclude_dirs' and symbolic links to folders are not searched.
+
+    Returns:
+      dict: the paths to all role folders and archives, by their file name
+    """
+
+    result = {}
+    for repo in role_repos:
+        repo = os.path.expanduser(repo)
+        if not os.path.isdir(repo):
+            continue
+        repo_roles = {}
+        for root, dirnames, filenames in os.walk(os.path.realpath(repo), topdown=True, followlinks=False):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and d not in exclude_dirs)
+            for d in dirnames:
+                path = os.path.join(root, d)
+                if is_repo_role_dir(path):
+                    repo_roles.setdefault(d, path)
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if is_role_archive(path):
+                    repo_roles.setdefault(filename, path)
+            # don't descend into roles
+            dirnames[:] = [d for d in dirnames if not is_repo_role_dir(os.path.join(root, d))]
+        result.update(repo_roles)
+
+    return result
+
+
+def find_local_role(name, version=None, local_roles={}):
+    """Finds a role (folder or archive) with the provided name in an index of local roles.
+
+    Roles with a version are only ever found as archives called '<name>-<version>.<ext>'.
+    Roles without a version are found as folders called '<name>', or as archives called
+    '<name>.<ext>'.
+
+    Args:
+      name (str): the role name
+      version (str): the role version
+      local_roles (dict): the local roles, as returned by 'index_local_roles'
+
+    Returns:
+      str: the path to the role folder or archive, or None if it can't be found
+    """
+
+    if version:
+        candidates = ["{}-{}{}".format(name, version, ext) for ext in ROLE_ARCHIVE_EXTENSIONS]
+    else:
+        candidates = [name] + ["{}{}".format(name, ext) for ext in ROLE_ARCHIVE_EXTENSIONS]
+
+    for c in candidates:
+        if c in local_roles.keys():
+            return local_roles[c]
+
+    return None
+
+
+def calculate_source_fingerprint(path):
+    """Calculates a cheap fingerprint of a role folder or archive, from file names, sizes and modification times only."""
+
+    digest = hashlib.sha256()
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        digest.update("{}:{}".format(st.st_size, st.st_mtime).encode("utf-8"))
+        return digest.hexdigest()
+
+    for root, dirnames, filenames in os.walk(path, topdown=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            st = os.lstat(file_path)
+            digest.update("{}\0{}:{}\0".format(os.path.relpath(file_path, path), st.st_size, st.st_mtime).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def calculate_dir_digest(path):
+    """Calculates a hash over the relative paths and content of all files in a folder."""
+
+    digest = hashlib.sha256()
+    for root, dirnames, filenames in os.walk(path, topdown=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            rel_path = os.path.relpath(file_path, path)
+            digest.update(rel_path.encode("utf-8"))
+            digest.update(b"\0")
+            if os.path.islink(file_path):
+                digest.update(os.readlink(file_path).encode("utf-8"))
+            else:
+                with open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(65536), b""):
+                        digest.update(chunk)
+            digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def get_dir_size(path):
+
+    size = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def extract_role_archive(archive, target):
+    """Extracts a role archive, refusing members that would end up outside of the target folder.
+
+    Returns:
+      str: the root folder of the role within the target folder
+    """
+
+    target = os.path.realpath(target)
+
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf:
+            members = zf.namelist()
+            _check_archive_members(members, target)
+            zf.extractall(target)
+    else:
+        with tarfile.open(archive) as tf:
+            members = tf.getmembers()
+            _check_archive_members([m.name for m in members], target)
+            for m in members:
+                if m.issym() or m.islnk() or m.isdev():
+                    raise Exception("Role archive '{}' contains unsupported member: {}".format(archive, m.name))
+            tf.extractall(target)
+
+    # archives usually contain a single parent folder
+    root = target
+    while not is_role_dir(root):
+        children = os.listdir(root)
+        if len(children) != 1 or not os.path.isdir(os.path.join(root, children[0])):
+            raise Exception("Can't find role in archive: {}".format(archive))
+        root = os.path.join(root, children[0])
+
+    return root
+
+
+def _check_archive_members(names, target):
+
+    for name in names:
+        path = os.path.realpath(os.path.join(target, name))
+        if path != target and not path.startswith(target + os.sep):
+            raise Exception("Invalid path in role archive: {}".format(name))
+
+
+class RoleStore(object):
+    """A local, content-addressed store for Ansible roles.
+
+    Roles are resolved from local folders or archives only (either a 'src' path, or by name from
+    a list of local role repositories), and stored once per content hash, so identical versions are
+    only kept once. Generated Ansible environments get symbolic links to the stored roles instead
+    of copies.
+
+    The store keeps an index of role sources (path and version), with a cheap fingerprint (file
+    names, sizes and modification times) of their content, so a source is only hashed and copied
+    again once it changes. The index also remembers roles that could not be found locally for
+    'missing_ttl' seconds, so the role repositories are not searched for them on every run. Changes
+    to the index are protected by a file lock, so concurrent runs can share a store.
+
+    Least recently used roles are removed once the store exceeds 'max_size', except for roles that
+    were used within the last 'min_age' seconds (as they might still be used by a running run).
+
+    Args:
+      path (str): the store folder
+      max_size (int): the maximum size of all stored roles, in bytes
+      role_repos (list): the role repositories to look for roles and role archives (see 'get_local_role_repos')
+      missing_ttl (float): how long to remember roles that can't be found locally, in seconds
+      min_age (float): the minimum time since a role was used last before it can be evicted, in seconds
+    """
+
+    def __init__(self, path=DEFAULT_ROLE_STORE_PATH, max_size=DEFAULT_ROLE_STORE_MAX_SIZE, role_repos=[],
+                 missing_ttl=DEFAULT_MISSING_ROLE_TTL, min_age=DEFAULT_ROLE_STORE_MIN_AGE):
+
+        self.path = path
+        self.max_size = max_size
+        self.role_repos = role_repos
+        self.missing_ttl = missing_ttl
+        self.min_age = min_age
+        self.objects_path = os.path.join(self.path, "objects")
+        self.index_file = os.path.join(self.path, ROLE_STORE_INDEX_FILE)
+        self.lock_file = os.path.join(self.path, ROLE_STORE_LOCK_FILE)
+        self._local_roles = None
+
+    @property
+    def local_roles(self):
+        """All roles in the local role repositories, by file name (the repositories are only searched once)."""
+
+        if self._local_roles is None:
+            self._local_roles = index_local_roles(self.role_repos)
+        return self._local_roles
+
+    def load_index(self):
+        """Reads the index of the store (without locking it)."""
+
+        index = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+            except (Exception) as e:
+                log.warning("Can't read role store index, starting with an empty one: {}".format(e))
+        for key in ["sources", "objects", "missing"]:
+            index.setdefault(key, {})
+        return index
+
+    def _save_index(self, index):
+
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        getattr(os, "replace", os.rename)(temp_path, self.index_file)
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        """Context manager that locks the store, and yields its index, which is saved afterwards."""
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(self.lock_file, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                index = self.load_index()
+                yield index
+                self._save_index(index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def resolve(self, name, src=None, version=None):
+        """Returns the local path (folder or archive) of a role, or None if it can't be found locally.
+
+        Roles with a 'src' that is not a local path (e.g. a git url) are never looked up by name,
+        they are left to nsbl.
+        """
+
+        if src:
+            local_src = os.path.expanduser(src)
+            if is_role_dir(local_src) or is_role_archive(local_src):
+                return local_src
+            if src != name:
+                return None
+
+        return find_local_role(name, version=version, local_roles=self.local_roles)
+
+    def is_recently_missing(self, index, name, version=None):
+        """Returns whether a role was recorded as missing within the last 'missing_ttl' seconds."""
+
+        missing_since = index["missing"].get(_missing_key(name, version), None)
+        return missing_since is not None and time.time() - missing_since < self.missing_ttl
+
+    def add(self, path):
+        """Adds the role at the provided path (folder or archive) to the store objects.
+
+        This doesn't update the index.
+
+        Returns:
+          str: the content hash of the role
+        """
+
+        if not os.path.isdir(self.objects_path):
+            os.makedirs(self.objects_path)
+
+        temp_dir = tempfile.mkdtemp(dir=self.path, prefix=".add_")
+        try:
+            if is_role_archive(path):
+                role_dir = extract_role_archive(path, os.path.join(temp_dir, "extracted"))
+            else:
+                role_dir = path
+
+            digest = calculate_dir_digest(role_dir)
+            object_path = os.path.join(self.objects_path, digest)
+            if not os.path.exists(object_path):
+                temp_object = os.path.join(temp_dir, "object")
+                shutil.copytree(role_dir, temp_object, symlinks=True)
+                try:
+                    os.rename(temp_object, object_path)
+                except (OSError):
+                    # added concurrently
+                    if not os.path.exists(object_path):
+                        raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return digest
+
+    def _store(self, spec, path, index):
+
+        source_key = _source_key(path, spec["version"])
+        fingerprint = calculate_source_fingerprint(path)
+
+        source = index["sources"].get(source_key, None)
+        if source is not None and source.get("fingerprint", None) == fingerprint and \
+                os.path.isdir(os.path.join(self.objects_path, source.get("digest", ""))):
+            digest = source["digest"]
+        else:
+            log.debug("Adding role '{}' to store: {}".format(spec["name"], path))
+            digest = self.add(path)
+
+        return (source_key, {"name": spec["name"], "version": spec["version"], "fingerprint": fingerprint, "digest": digest})
+
+    def checkout(self, roles, use_missing_cache=True):
+        """Makes sure all provided roles are in the store (and up to date), if they can be resolved locally.
+
+        Args:
+          roles: a role description, as used in the '__freckles__' metadata of a frecklecutable
+          use_missing_cache (bool): whether to skip looking up roles that were recently recorded as missing
+
+        Returns:
+          tuple: a dict of role names and paths of the stored roles, and a list of the role specs that could not be found
+        """
+
+        # resolving and copying roles happens without holding the lock, objects are added atomically
+        index = self.load_index()
+
+        stored = {}
+        missing = []
+        new_missing = []
+        sources = {}
+        for spec in parse_role_specs(roles):
+            if use_missing_cache and self.is_recently_missing(index, spec["name"], spec["version"]):
+                log.debug("Role '{}' was recently not found locally, not looking for it".format(spec["name"]))
+                missing.append(spec)
+                continue
+            path = self.resolve(spec["name"], src=spec["src"], version=spec["version"])
+            if path is None:
+                missing.append(spec)
+                new_missing.append(spec)
+                continue
+            source_key, source = self._store(spec, path, index)
+            sources[source_key] = source
+            stored[spec["name"]] = os.path.join(self.objects_path, source["digest"])
+
+        if not sources and not new_missing:
+            return (stored, missing)
+
+        now = time.time()
+        with self.locked_index() as index:
+            for source_key, source in sources.items():
+                index["sources"][source_key] = source
+                details = index["objects"].setdefault(source["digest"], {})
+                if "size" not in details.keys():
+                    details["size"] = get_dir_size(os.path.join(self.objects_path, source["digest"]))
+                details["last_used"] = now
+                index["missing"].pop(_missing_key(source["name"], source["version"]), None)
+            for spec in new_missing:
+                index["missing"][_missing_key(spec["name"], spec["version"])] = now
+            self._evict(index, keep=[s["digest"] for s in sources.values()])
+
+        return (stored, missing)
+
+    def prefetch(self, roles):
+        """Resolves and stores all provided roles, looking up roles that were recorded as missing again.
+
+        Args:
+          roles: a role description, as used in the '__freckles__' metadata of a frecklecutable
+
+        Returns:
+          list: the role specs that could not be found locally
+        """
+
+        stored, missing = self.checkout(roles, use_missing_cache=False)
+        for spec in missing:
+            log.debug("Can't find role '{}' locally".format(spec["name"]))
+
+        return missing
+
+    def link_roles(self, stored_roles, target_dir):
+        """Links stored roles into the provided folder (usually the 'roles/external' folder of an environment).
+
+        Args:
+          stored_roles (dict): role names and paths, as returned by 'checkout'
+          target_dir (str): the folder to create the links in
+        """
+
+        if not stored_roles:
+            return
+
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        for name, object_path in stored_roles.items():
+            link = os.path.join(target_dir, name)
+            if os.path.lexists(link):
+                log.debug("Not linking role '{}', already exists in environment".format(name))
+                continue
+            os.symlink(object_path, link)
+
+    def evict(self, keep=[]):
+        """Removes least recently used roles until the store is within its size limit."""
+
+        with self.locked_index() as index:
+            self._evict(index, keep=keep)
+
+    def _evict(self, index, keep=[]):
+
+        objects = index["objects"]
+        on_disk = os.listdir(self.objects_path) if os.path.isdir(self.objects_path) else []
+
+        # objects can be missing from the index (e.g. after a failed run), they still count
+        for digest in on_disk:
+            if digest not in objects.keys():
+                object_path = os.path.join(self.objects_path, digest)
+                objects[digest] = {"size": get_dir_size(object_path), "last_used": os.path.getmtime(object_path)}
+        for digest in list(objects.keys()):
+            if digest not in on_disk:
+                del objects[digest]
+
+        total_size = sum(details.get("size", 0) for details in objects.values())
+        if total_size <= self.max_size:
+            return
+
+        min_last_used = time.time() - self.min_age
+        by_last_use = sorted(objects.keys(), key=lambda d: objects[d].get("last_used", 0))
+        for digest in by_last_use:
+            if total_size <= self.max_size:
+                break
+            if digest in keep or objects[digest].get("last_used", 0) > min_last_used:
+                continue
+            log.debug("Evicting role from store: {}".format(digest))
+            # move the object out of the way first, so it disappears atomically
+            temp_path = tempfile.mkdtemp(dir=self.path, prefix=".evict_")
+            os.rename(os.path.join(self.objects_path, digest), os.path.join(temp_path, digest))
+            shutil.rmtree(temp_path, ignore_errors=True)
+            total_size -= objects.pop(digest).get("size", 0)
+            for source_key, source in list(index["sources"].items()):
+                if source.get("digest", None) == digest:
+                    del index["sources"][source_key]
+
+        if total_size > self.max_size:
+            log.warning("Role store is over its size limit, but all roles are in use.")
+
+
+def _source_key(path, version):
+
+    return "{}@{}".format(os.path.realpath(path), version or "")
+
+
+def _missing_key(name, version):
+
+    return "{}@{}".format(name, version or "")
@@ -3,17 +3,28 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+import sys
 from collections import OrderedDict
+from timeit import default_timer
 
 import yaml
 from frkl import frkl
-from luci import DictletFinder, TextFileDictletReader, JINJA_DELIMITER_PROFILES
+from luci import DictletFinder, TextFileDictletReader, JINJA_DELIMITER_PROFILES, replace_string
 
 from freckles.freckles_base_cli import parse_tasks_dictlet
 from freckles.freckles_defaults import *
+from freckles.utils import freckles_jinja_extensions
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 log = logging.getLogger("freckles")
 
+# plain dicts keep insertion order (and are smaller) from Python 3.7 on
+IndexDict = dict if sys.version_info >= (3, 7) else OrderedDict
+
 def print_task_list_details(task_config, task_metadata={}, output_format="default", ask_become_pass="auto",
                             run_parameters={}):
     """Prints the details of a frecklecutable run (if started with the 'no-run' option).
@@ -53,6 +64,46 @@ def print_task_list_details(task_config, task_metadata={}, output_format="defaul
         click.echo(output)
         click.echo("")
 
+def render_frecklecutable_templates(command_name, metadata, all_vars, metrics=None):
+    """Renders the 'vars' and 'tasks' templates of a frecklecutable.
+
+    The rendered 'vars' are merged on top of the provided variables, and the result is used
+    to render the 'tasks'.
+
+    Args:
+      command_name (str): the name of the frecklecutable
+      metadata (dict): the metadata of the frecklecutable
+      all_vars (dict): the variables to use for templating
+      metrics (RunMetrics): optional metrics object to record render times in
+
+    Returns:
+      tuple: the rendered tasks string, and the variables including the rendered 'vars'
+    """
+
+    tasks_string = metadata.get(FX_TASKS_KEY_NAME, "")
+    vars_string = metadata.get(FX_VARS_KEY_NAME, "")
+
+    start = default_timer()
+    replaced_vars = replace_string(vars_string, all_vars, additional_jinja_extensions=freckles_jinja_extensions, **JINJA_DELIMITER_PROFILES["luci"])
+    if metrics is not None:
+        metrics.inc("template_render_duration_seconds", default_timer() - start, frecklecutable=command_name, template="vars")
+    try:
+        vars_dictlet = yaml.safe_load(replaced_vars)
+    except (Exception) as e:
+        raise Exception("Can't parse vars: {}".format(e))
+
+    if vars_dictlet:
+        temp_new_all_vars = frkl.dict_merge(all_vars, vars_dictlet, copy_dct=True)
+    else:
+        temp_new_all_vars = all_vars
+
+    start = default_timer()
+    replaced_tasks = replace_string(tasks_string, temp_new_all_vars, additional_jinja_extensions=freckles_jinja_extensions, **JINJA_DELIMITER_PROFILES["luci"])
+    if metrics is not None:
+        metrics.inc("template_render_duration_seconds", default_timer() - start, frecklecutable=command_name, template="tasks")
+
+    return (replaced_tasks, temp_new_all_vars)
+
 def find_frecklecutable_dirs(path, use_root_path=True):
     """Helper method to find 'child' frecklecutable dirs.
 
@@ -103,21 +154,87 @@ def is_frecklecutable(file_path, allow_dots_in_filename=False):
 
     return True
 
-def find_frecklecutables_in_folder(path, allow_dots_in_filename=False):
+def iter_frecklecutables_in_folder(path, allow_dots_in_filename=False, metrics=None):
+    """Yields the names and (real) paths of all frecklecutables in a folder."""
 
-    result = OrderedDict()
     for child in os.listdir(path):
 
+        if metrics is not None:
+            metrics.inc("discovery_files_scanned")
+
         file_path = os.path.realpath(os.path.join(path, child))
 
         if not is_frecklecutable(file_path):
             continue
 
+        yield (child, file_path)
+
+def find_frecklecutables_in_folder(path, allow_dots_in_filename=False, metrics=None):
+
+    result = OrderedDict()
+    for child, file_path in iter_frecklecutables_in_folder(path, allow_dots_in_filename=allow_dots_in_filename, metrics=metrics):
         result[child] = {"path": file_path, "type": "file"}
 
     return result
 
 
+class FrecklecutableEntry(Mapping):
+    """Compact, read-only details of a frecklecutable.
+
+    Behaves like the '{"path": ..., "type": "file"}' dict other finders return, but only keeps
+    references to the (shared) folder and file name strings. It is not a 'dict' subclass, use
+    'dict(entry)' where a real dict is needed. Entries can be copied and pickled.
+    """
+
+    __slots__ = ("name", "folder", "filename")
+
+    KEYS = ("path", "type")
+
+    def __init__(self, name, folder, filename):
+
+        self.name = name
+        self.folder = folder
+        self.filename = filename
+
+    @property
+    def path(self):
+
+        return os.path.join(self.folder, self.filename)
+
+    def __getitem__(self, key):
+
+        if key == "path":
+            return self.path
+        elif key == "type":
+            return "file"
+        raise KeyError(key)
+
+    def __iter__(self):
+
+        return iter(FrecklecutableEntry.KEYS)
+
+    def __len__(self):
+
+        return len(FrecklecutableEntry.KEYS)
+
+    def __repr__(self):
+
+        return "FrecklecutableEntry(name={!r}, path={!r})".format(self.name, self.path)
+
+    def __reduce__(self):
+
+        return (FrecklecutableEntry, (self.name, self.folder, self.filename))
+
+    def __copy__(self):
+
+        # entries are immutable
+        return self
+
+    def __deepcopy__(self, memo):
+
+        return self
+
+
 class FrecklecutableFinder(DictletFinder):
     """Finder class for frecklecutables.
 
@@ -128,41 +245,88 @@ class FrecklecutableFinder(DictletFinder):
     it.
 
     Frecklecutables are not allowed to have a '.' in their file name (for now anyway).
+
+    Found frecklecutables are kept as :class:`FrecklecutableEntry` objects, in one tuple per
+    context repo ('path_cache'), with folder names shared between entries, and a single name index
+    ('frecklecutable_cache') that is used for lookups and returned by 'get_all_dictlets'.
+
+    If a :class:`~frecklecute.metrics.RunMetrics` object is provided, discovery time, the number
+    of files scanned and hits/misses of the per-path cache are recorded in it.
     """
 
-    def __init__(self, paths, **kwargs):
+    def __init__(self, paths, metrics=None, **kwargs):
 
         super(FrecklecutableFinder, self).__init__(**kwargs)
         self.paths = paths
+        self.metrics = metrics
         self.frecklecutable_cache = None
         self.path_cache = {}
+        self._indexed_paths = None
+        self._folders = {}
 
-    def get_all_dictlet_names(self):
+    def _create_entry(self, name, file_path):
 
-        return self.get_all_dictlets().keys()
+        folder, filename = os.path.split(file_path)
+        folder = self._folders.setdefault(folder, folder)
+        if filename == name:
+            filename = name
 
-    def get_all_dictlets(self):
-        """Find all frecklecutables."""
+        return FrecklecutableEntry(name, folder, filename)
 
-        if self.frecklecutable_cache is None:
-            self.frecklecutable_cache = {}
-        all_frecklecutables = OrderedDict()
+    def _scan_path(self, path):
+
+        start = default_timer()
+        entries = []
+        for f_dir in find_frecklecutable_dirs(path):
+            for name, file_path in iter_frecklecutables_in_folder(f_dir, metrics=self.metrics):
+                entries.append(self._create_entry(name, file_path))
+
+        if self.metrics is not None:
+            self.metrics.inc("discovery_duration_seconds", default_timer() - start)
+
+        return tuple(entries)
+
+    def _get_index(self):
+
+        paths = list(self.paths)
+        if self.frecklecutable_cache is not None and paths == self._indexed_paths:
+            if self.metrics is not None:
+                self.metrics.inc("cache_hits", cache="finder_path", amount=len(paths))
+            return self.frecklecutable_cache
 
-        for path in self.paths:
+        index = IndexDict()
+        for path in paths:
             if path not in self.path_cache.keys():
-                commands = OrderedDict()
-                dirs = find_frecklecutable_dirs(path)
+                if self.metrics is not None:
+                    self.metrics.inc("cache_misses", cache="finder_path")
+                self.path_cache[path] = self._scan_path(path)
+            elif self.metrics is not None:
+                self.metrics.inc("cache_hits", cache="finder_path")
 
-                for f_dir in dirs:
-                    fx = find_frecklecutables_in_folder(f_dir)
-                    frkl.dict_merge(commands, fx, copy_dct=False)
+            # later paths override frecklecutables with the same name
+            for entry in self.path_cache[path]:
+                index[entry.name] = entry
 
-                self.path_cache[path] = commands
-                frkl.dict_merge(self.frecklecutable_cache, commands, copy_dct=False)
+        self.frecklecutable_cache = index
+        self._indexed_paths = paths
 
-            frkl.dict_merge(all_frecklecutables, self.path_cache[path], copy_dct=False)
+        return index
 
-        return all_frecklecutables
+    def get_all_dictlet_names(self):
+
+        return self._get_index().keys()
+
+    def get_all_dictlets(self):
+        """Find all frecklecutables.
+
+        The returned dict is the finder's index itself (not a copy), so it must not be modified.
+        Callers in frecklecute only iterate over it.
+
+        Returns:
+          dict: an (insertion-ordered) dict of frecklecutable names and details
+        """
+
+        return self._get_index()
 
     def get_dictlet(self, name):
 
@@ -171,16 +335,12 @@ class FrecklecutableFinder(DictletFinder):
             # try path first
             abs_file = os.path.realpath(name)
             if os.path.isfile(abs_file) and is_frecklecutable(abs_file):
-                dictlet = {"path": abs_file, "type": "file"}
+                dictlet = self._create_entry(name, abs_file)
 
         if dictlet is None:
-            self.get_all_dictlet_names()
-            dictlet = self.frecklecutable_cache.get(name, None)
+            dictlet = self._get_index().get(name, None)
 
-        if dictlet is None:
-            return None
-        else:
-            return dictlet
+        return dictlet
 
 class FrecklecutableReader(TextFileDictletReader):
     """Reads a text file and generates metadata for frecklecute.
@@ -207,3 +367,24 @@ class FrecklecutableReader(TextFileDictletReader):
         result = parse_tasks_dictlet(content, current_vars, self.tasks_keyword, self.vars_keyword, self.delimiter_profile)
 
         return result
+
+
+def read_frecklecutable_metadata(path, reader=None, current_vars={}):
+    """Reads and parses a frecklecutable file.
+
+    Args:
+      path (str): the path to the frecklecutable
+      reader (FrecklecutableReader): the reader to use, a default one is created if not provided
+      current_vars (dict): variables to use when parsing
+
+    Returns:
+      dict: the metadata of the frecklecutable
+    """
+
+    if reader is None:
+        reader = FrecklecutableReader()
+
+    with open(path) as f:
+        content = f.read()
+
+    return reader.process_lines(content, current_vars)
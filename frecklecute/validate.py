@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+"""Validation of frecklecutables, without generating an environment or running them."""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+
+from luci import ordered_load
+from six import string_types
+
+from freckles import __version__ as freckles_version
+from freckles.freckles_base_cli import get_task_list_format, process_extra_task_lists
+from . import __version__
+from .utils import FrecklecutableReader, read_frecklecutable_metadata, render_frecklecutable_templates
+
+log = logging.getLogger("freckles")
+
+DEFAULT_VALIDATION_STATE_FILE = os.path.join(os.path.expanduser("~"), ".freckles", "cache", "frecklecute", "validated.json")
+VALID_TASK_LIST_FORMATS = ["freckles", "ansible"]
+VALID_ARG_KEYS = ["help", "type", "default", "required", "is_var", "multiple", "is_flag", "arg_name", "metavar", "sample", "envvar", "show_default"]
+ARG_TYPE_SAMPLES = {
+    "int": 1,
+    "integer": 1,
+    "float": 1.0,
+    "bool": True,
+    "boolean": True,
+    "list": ["sample"],
+    "dict": {"sample": "sample"}
+}
+
+
+def calculate_file_digest(path):
+    """Calculates a hash over the content of a file, and the versions of frecklecute and freckles.
+
+    As freckles does the actual parsing (e.g. determining the task-list format), an upgrade of
+    either invalidates all previous validation results.
+    """
+
+    digest = hashlib.sha256("{}:{}".format(__version__, freckles_version).encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def find_referenced_files(value, base_dir):
+    """Recursively finds all strings in a value that are paths to existing files (absolute, or relative to 'base_dir')."""
+
+    result = []
+    if isinstance(value, string_types):
+        if "\n" not in value and len(value) < 4096:
+            path = os.path.join(base_dir, os.path.expanduser(value))
+            if os.path.isfile(path):
+                result.append(os.path.realpath(path))
+    elif isinstance(value, dict):
+        for v in value.values():
+            result.extend(find_referenced_files(v, base_dir))
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            result.extend(find_referenced_files(v, base_dir))
+
+    return result
+
+
+def get_arg_spec(metadata):
+    """Returns the arg spec of a frecklecutable as a dict of arg names and details."""
+
+    args = metadata.get("args", None)
+    if not args:
+        return OrderedDict()
+
+    if isinstance(args, (list, tuple)):
+        result = OrderedDict()
+        for arg in args:
+            if isinstance(arg, string_types):
+                result[arg] = {}
+            elif isinstance(arg, dict):
+                result.update(arg)
+            else:
+                raise Exception("Invalid arg: {}".format(arg))
+        return result
+
+    if not isinstance(args, dict):
+        raise Exception("'args' needs to be a list or dict, not: {}".format(type(args).__name__))
+
+    return args
+
+
+def check_arg_spec(arg_spec):
+    """Checks the arg spec of a frecklecutable.
+
+    Returns:
+      tuple: a list of errors and a list of warnings
+    """
+
+    errors = []
+    warnings = []
+    for name, details in arg_spec.items():
+        if not isinstance(name, string_types):
+            errors.append("Invalid arg name: {}".format(name))
+            continue
+        if details is None:
+            continue
+        if not isinstance(details, dict):
+            errors.append("Details for arg '{}' need to be a dict".format(name))
+            continue
+        for key in details.keys():
+            if key not in VALID_ARG_KEYS:
+                warnings.append("Unknown key '{}' for arg '{}'".format(key, name))
+        for key in ["required", "is_var", "multiple", "is_flag"]:
+            if key in details.keys() and not isinstance(details[key], bool):
+                errors.append("Value of '{}' for arg '{}' needs to be a boolean".format(key, name))
+
+    return (errors, warnings)
+
+
+def create_sample_vars(arg_spec, defaults=None):
+    """Creates sample values for all args of a frecklecutable, to be used for test-rendering its templates."""
+
+    sample_vars = OrderedDict()
+    if isinstance(defaults, dict):
+        sample_vars.update(defaults)
+
+    for name, details in arg_spec.items():
+        if name in sample_vars.keys():
+            continue
+        if not details:
+            details = {}
+
+        if details.get("default", None) is not None:
+            value = details["default"]
+        elif "sample" in details.keys():
+            value = details["sample"]
+        elif details.get("is_flag", False):
+            value = True
+        else:
+            value = ARG_TYPE_SAMPLES.get(details.get("type", None), "sample_{}".format(name))
+            if details.get("multiple", False) and not isinstance(value, list):
+                value = [value]
+        sample_vars[name] = value
+
+    return sample_vars
+
+
+def validate_frecklecutable(name, path):
+    """Parses a frecklecutable, checks its arg spec and renders its templates with sample values.
+
+    Returns:
+      dict: the validation result, with 'errors' and 'warnings' lists
+    """
+
+    result = {"name": name, "path": path, "errors": [], "warnings": [], "task_list_format": None, "dependencies": []}
+
+    try:
+        metadata = read_frecklecutable_metadata(path, reader=FrecklecutableReader())
+    except (Exception) as e:
+        result["errors"].append("Can't parse file: {}".format(e))
+        return result
+
+    try:
+        arg_spec = get_arg_spec(metadata)
+    except (Exception) as e:
+        result["errors"].append("Invalid arg spec: {}".format(e))
+        return result
+    errors, warnings = check_arg_spec(arg_spec)
+    result["errors"].extend(errors)
+    result["warnings"].extend(warnings)
+
+    freckles_metadata = metadata.get("__freckles__", {})
+    task_list_format = freckles_metadata.get("task_list_format", None)
+    if task_list_format is not None and task_list_format not in VALID_TASK_LIST_FORMATS:
+        result["errors"].append("Invalid task-list format: {}".format(task_list_format))
+
+    try:
+        extra_task_lists = process_extra_task_lists(metadata, path)
+        # external task lists need to be re-validated when they change
+        result["dependencies"] = sorted(set(find_referenced_files(extra_task_lists, os.path.dirname(os.path.abspath(path)))))
+    except (Exception) as e:
+        result["errors"].append("Can't process extra task lists: {}".format(e))
+
+    sample_vars = create_sample_vars(arg_spec, metadata.get("defaults", None))
+    try:
+        replaced_tasks, _ = render_frecklecutable_templates(name, metadata, sample_vars)
+        tasks = ordered_load(replaced_tasks)
+    except (Exception) as e:
+        result["errors"].append("Can't render templates: {}".format(e))
+        return result
+
+    if not tasks:
+        result["errors"].append("No tasks")
+        return result
+    if not isinstance(tasks, (list, tuple)):
+        result["errors"].append("Tasks need to be a list")
+        return result
+
+    if task_list_format is None:
+        task_list_format = get_task_list_format(tasks)
+        if task_list_format is None:
+            result["warnings"].append("Could not determine task-list format")
+    result["task_list_format"] = task_list_format
+
+    return result
+
+
+def _validate_frecklecutable(args):
+
+    return validate_frecklecutable(*args)
+
+
+class ValidationState(object):
+    """Keeps track of the content hashes of all frecklecutables that were validated successfully.
+
+    The hashes of the files a frecklecutable depends on (e.g. external task lists) are kept too, a
+    frecklecutable is only unchanged if none of them changed either.
+
+    Args:
+      path (str): the state file
+    """
+
+    def __init__(self, path=DEFAULT_VALIDATION_STATE_FILE):
+
+        self.path = path
+        self.valid = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.valid = json.load(f)
+            except (Exception) as e:
+                log.warning("Can't read validation state, validating all frecklecutables: {}".format(e))
+
+    def is_unchanged(self, path, digest):
+
+        details = self.valid.get(path, None)
+        if not isinstance(details, dict) or details.get("digest", None) != digest:
+            return False
+
+        for dependency, dependency_digest in details.get("dependencies", {}).items():
+            try:
+                if calculate_file_digest(dependency) != dependency_digest:
+                    return False
+            except (IOError, OSError):
+                return False
+
+        return True
+
+    def update(self, path, digest, is_valid, dependencies=[]):
+
+        if not is_valid:
+            self.valid.pop(path, None)
+            return
+
+        try:
+            dependency_digests = dict((d, calculate_file_digest(d)) for d in dependencies)
+        except (IOError, OSError) as e:
+            log.debug("Can't read dependency of '{}', not storing validation result: {}".format(path, e))
+            self.valid.pop(path, None)
+            return
+
+        self.valid[path] = {"digest": digest, "dependencies": dependency_digests}
+
+    def save(self):
+
+        target_dir = os.path.dirname(self.path)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        fd, temp_path = tempfile.mkstemp(dir=target_dir, prefix=".validated.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.valid, f, indent=2, sort_keys=True)
+        getattr(os, "replace", os.rename)(temp_path, self.path)
+
+
+def validate_frecklecutables(dictlets, processes=None, state=None, force=False):
+    """Validates frecklecutables in parallel, yielding the results as soon as they are available.
+
+    Frecklecutables whose content (or the content of the files they depend on) didn't change since
+    their last successful validation are not validated again (unless 'force' is set), their result
+    has the 'skipped' key set.
+
+    Args:
+      dictlets (dict): frecklecutable names and details, as returned by FrecklecutableFinder.get_all_dictlets
+      processes (int): the number of worker processes, defaults to the number of cpus
+      state (ValidationState): the validation state, no state is kept if not provided
+      force (bool): whether to validate unchanged frecklecutables too
+    """
+
+    digests = {}
+    to_validate = []
+    for name, details in dictlets.items():
+        path = details["path"]
+        try:
+            digest = calculate_file_digest(path)
+        except (IOError, OSError) as e:
+            yield {"name": name, "path": path, "errors": ["Can't read file: {}".format(e)], "warnings": [], "task_list_format": None}
+            continue
+        digests[path] = digest
+        if state is not None and not force and state.is_unchanged(path, digest):
+            yield {"name": name, "path": path, "errors": [], "warnings": [], "task_list_format": None, "skipped": True}
+            continue
+        to_validate.append((name, path))
+
+    if not to_validate:
+        return
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(to_validate))
+
+    if processes <= 1:
+        results = (validate_frecklecutable(*args) for args in to_validate)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_validate_frecklecutable, to_validate)
+
+    try:
+        for result in results:
+            if state is not None:
+                state.update(result["path"], digests[result["path"]], not result["errors"],
+                             dependencies=result.get("dependencies", []))
+            yield result
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if state is not None:
+            state.save()
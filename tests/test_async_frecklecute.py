@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.async_frecklecute`."""
+
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+if sys.version_info < (3, 5):
+    pytest.skip("asyncio support requires Python 3.5+", allow_module_level=True)
+
+import asyncio
+
+from timeit import default_timer
+
+from frecklecute import async_frecklecute
+from frecklecute.async_frecklecute import AsyncFrecklecute, AsyncFrecklecuteRun, render_run_environment
+from frecklecute.frecklecute import Frecklecutable
+from frecklecute.metrics import RunMetrics
+
+
+def create_script(tmpdir, content):
+    script = os.path.join(str(tmpdir), "run_all_plays.sh")
+    with open(script, "w") as f:
+        f.write("#!/bin/sh\n")
+        f.write(content)
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    return script
+
+
+def collect_events(run):
+    loop = asyncio.new_event_loop()
+    events = []
+    try:
+        while True:
+            try:
+                events.append(loop.run_until_complete(run.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.close()
+    return events
+
+
+def test_run_events(tmpdir):
+    lines = [json.dumps({"category": "play_start"}), json.dumps({"category": "ok", "status": "changed"}),
+             "not json", json.dumps({"category": "failed"})]
+    script = create_script(tmpdir, "".join("echo '{}'\n".format(l) for l in lines) + "exit 2\n")
+    metrics = RunMetrics()
+
+    run = AsyncFrecklecuteRun("test", {"run_playbooks_script": script}, metrics=metrics)
+    events = collect_events(run)
+
+    assert [e["category"] for e in events] == ["play_start", "ok", "output", "failed"]
+    assert events[2]["msg"] == "not json"
+    assert run.return_code == 2
+    assert run.parameters["return_code"] == 2
+    assert metrics.get("tasks", frecklecutable="test", status="ok") == 1
+    assert metrics.get("tasks", frecklecutable="test", status="changed") == 1
+    assert metrics.get("tasks", frecklecutable="test", status="failed") == 1
+    assert metrics.get("run_status", frecklecutable="test", status="failed") == 1
+
+
+def test_run_timeout(tmpdir):
+    script = create_script(tmpdir, "echo started\nsleep 30\n")
+    run = AsyncFrecklecuteRun("test", {"run_playbooks_script": script}, timeout=0.5)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(run.wait())
+    finally:
+        loop.close()
+
+    assert run.return_code is not None
+    assert run.process.returncode is not None
+
+
+class FakeConfig(object):
+    trusted_repos = []
+    task_descs = []
+
+
+class FakeNsbl(object):
+    created = []
+
+    def __init__(self, task_config, kwargs):
+        self.task_config = task_config
+        self.kwargs = kwargs
+
+    @classmethod
+    def create(cls, task_config, role_repos, task_descs, **kwargs):
+        obj = cls(task_config, kwargs)
+        cls.created.append(obj)
+        return obj
+
+
+class FakeNsblRunner(object):
+    """Renders a run folder with a script that outputs the 'script' var of the first task config item."""
+
+    def __init__(self, nsbl_obj):
+        self.nsbl_obj = nsbl_obj
+
+    def run(self, target, pre_run_callback=None, **kwargs):
+        assert kwargs["no_run"] is True
+        assert kwargs["callback"] == "nsbl_internal"
+        script = create_script(target, self.nsbl_obj.task_config[0]["vars"]["script"])
+        if pre_run_callback is not None:
+            pre_run_callback(target)
+        return {"env_dir": target, "run_playbooks_script": script}
+
+
+@pytest.fixture
+def fake_nsbl(monkeypatch):
+    FakeNsbl.created = []
+    monkeypatch.setattr(async_frecklecute, "nsbl", type("nsbl", (object,), {"Nsbl": FakeNsbl, "NsblRunner": FakeNsblRunner}))
+    monkeypatch.setattr(async_frecklecute, "get_local_role_repos", lambda config: [])
+    monkeypatch.setattr(async_frecklecute.nsbl_defaults, "calculate_role_repos", lambda repos, **kwargs: repos, raising=False)
+    return FakeNsbl
+
+
+def create_frecklecutable(name, script):
+    return Frecklecutable(name, [{"debug": {"msg": "hello"}}], {"script": script}, tasks_format="freckles")
+
+
+def run_in_loop(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_render_run_environment(tmpdir, fake_nsbl):
+    f = create_frecklecutable("test", "exit 0\n")
+    run = AsyncFrecklecute(f, config=FakeConfig())
+
+    first = render_run_environment(run, f, ["localhost"], run_base=str(tmpdir))
+    second = render_run_environment(run, f, ["localhost"], run_base=str(tmpdir))
+
+    assert first["env_dir"] != second["env_dir"]
+    assert os.path.dirname(first["env_dir"]) == str(tmpdir)
+    assert fake_nsbl.created[0].kwargs["wrap_into_hosts"] == ["localhost"]
+
+
+def test_concurrent_runs(tmpdir, fake_nsbl):
+    frecklecutables = [create_frecklecutable("test_{}".format(i), "sleep 1\necho '{}'\n".format(json.dumps({"category": "ok"})))
+                       for i in range(4)]
+    run = AsyncFrecklecute(frecklecutables, config=FakeConfig(), run_base=str(tmpdir))
+
+    async def run_all():
+        return await asyncio.gather(*[run.start_frecklecute_run(f.name) for f in frecklecutables])
+
+    start = default_timer()
+    results = run_in_loop(run_all())
+
+    # the runs happen at the same time, not one after the other
+    assert default_timer() - start < 3
+    assert [r["return_code"] for r in results] == [0, 0, 0, 0]
+    assert len(set(r["env_dir"] for r in results)) == 4
+    assert run.metrics.get("tasks", frecklecutable="test_0", status="ok") == 1
+
+
+def test_cancel_run(tmpdir, fake_nsbl):
+    f = create_frecklecutable("test", "echo '{}'\nsleep 30\n".format(json.dumps({"category": "play_start"})))
+    run = AsyncFrecklecute(f, config=FakeConfig(), run_base=str(tmpdir), remove_run_folders=True)
+
+    async def start_and_cancel():
+        frecklecute_run = await run.prepare_frecklecute_run("test")
+        events = []
+
+        async def consume():
+            async for event in frecklecute_run:
+                events.append(event)
+
+        task = asyncio.ensure_future(consume())
+        while not events:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return frecklecute_run
+
+    start = default_timer()
+    frecklecute_run = run_in_loop(start_and_cancel())
+
+    assert default_timer() - start < 10
+    assert frecklecute_run.process.returncode is not None
+    assert frecklecute_run.return_code != 0
+    assert not os.path.exists(frecklecute_run.parameters["env_dir"])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.cache`."""
+
+import os
+import time
+from collections import OrderedDict
+
+from frecklecute.cache import RenderCache
+from frecklecute.metrics import RunMetrics
+
+
+def test_create_key():
+    cache = RenderCache()
+    inputs = ["install-pkgs", "- apt: vim", OrderedDict([("user", "markus")]), ["localhost"]]
+
+    assert cache.create_key(*inputs) == cache.create_key(*inputs)
+    assert cache.create_key(*inputs) != cache.create_key("install-pkgs", "- apt: vim", {"user": "root"}, ["localhost"])
+    # inputs that can't be serialized without changing them can't be cached
+    assert cache.create_key({80: "http"}) is None
+    assert cache.create_key(object()) is None
+
+
+def test_get_and_set(tmpdir):
+    metrics = RunMetrics()
+    cache = RenderCache(path=str(tmpdir), metrics=metrics)
+    key = cache.create_key("test")
+
+    assert cache.get(key) is None
+    cache.set(key, {"tasks": ["a", "b"]})
+    assert cache.get(key) == {"tasks": ["a", "b"]}
+
+    assert metrics.get("cache_misses", cache="rendered") == 1
+    assert metrics.get("cache_hits", cache="rendered") == 1
+
+
+def test_lru_eviction(tmpdir):
+    cache = RenderCache(path=str(tmpdir), max_size=10 ** 6)
+    payload = "x" * 4000
+    keys = [cache.create_key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, payload)
+        entry = cache._entry_path(key)
+        os.utime(entry, (time.time() - 100 + i, time.time() - 100 + i))
+
+    # use the oldest entry, so the second one becomes the least recently used
+    assert cache.get(keys[0]) == payload
+    cache.max_size = 2 * os.path.getsize(cache._entry_path(keys[0]))
+    cache.evict()
+
+    assert cache.get(keys[0]) == payload
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == payload
+
+
+def test_unsafe_permissions(tmpdir):
+    cache = RenderCache(path=str(tmpdir))
+    key = cache.create_key("test")
+    cache.set(key, {"tasks": ["a"]})
+    assert cache.get(key) == {"tasks": ["a"]}
+
+    os.chmod(cache._entry_path(key), 0o666)
+    assert cache.get(key) is None
+
+    os.chmod(cache._entry_path(key), 0o600)
+    os.chmod(str(tmpdir), 0o777)
+    assert cache.get(key) is None
+
+
+def test_set_not_serializable(tmpdir):
+    cache = RenderCache(path=str(tmpdir))
+    key = cache.create_key("test")
+    cache.set(key, {"value": object()})
+
+    assert cache.get(key) is None
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_set_not_lossless(tmpdir):
+    cache = RenderCache(path=str(tmpdir))
+    key = cache.create_key("test")
+
+    cache.set(key, {"vars": {"ports": {80: "http"}}})
+    assert cache.get(key) is None
+    cache.set(key, {"vars": {True: "yes"}})
+    assert cache.get(key) is None
+
+    cache.set(key, {"vars": {"ports": [80, 443], "enabled": True, "ratio": 0.5, "groups": ("a", "b")}})
+    assert cache.get(key) == {"vars": {"ports": [80, 443], "enabled": True, "ratio": 0.5, "groups": ["a", "b"]}}
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.metrics`."""
+
+import json
+import os
+
+from frecklecute.metrics import RunMetrics
+
+
+def test_openmetrics_output():
+    metrics = RunMetrics()
+    metrics.set("tasks", 3, frecklecutable="install-pkgs", status="planned")
+    metrics.inc("cache_hits", cache="finder_path")
+    metrics.inc("cache_hits", cache="finder_path")
+    with metrics.timer("run_duration_seconds", frecklecutable="install-pkgs", phase="prepare"):
+        pass
+
+    output = metrics.to_openmetrics()
+    assert '# TYPE frecklecute_tasks gauge' in output
+    assert 'frecklecute_tasks{frecklecutable="install-pkgs",status="planned"} 3' in output
+    assert 'frecklecute_cache_hits{cache="finder_path"} 2' in output
+    assert 'frecklecute_run_duration_seconds{frecklecutable="install-pkgs",phase="prepare"}' in output
+    assert output.endswith("# EOF\n")
+
+
+def test_label_escaping():
+    metrics = RunMetrics()
+    metrics.set("run_return_code", 0, frecklecutable='a"b\\c')
+
+    assert 'frecklecutable="a\\"b\\\\c"' in metrics.to_openmetrics()
+
+
+def test_write_json(tmpdir):
+    metrics = RunMetrics()
+    metrics.set("discovery_files_scanned", 12)
+    target = os.path.join(str(tmpdir), "frecklecute.json")
+
+    metrics.write(target, metrics_format="json")
+
+    with open(target) as f:
+        content = json.load(f)
+    assert content["discovery_files_scanned"]["samples"][0]["value"] == 12
+    assert "last_run_timestamp_seconds" in content
+    assert os.listdir(str(tmpdir)) == ["frecklecute.json"]
+
+
+def test_run_status():
+    metrics = RunMetrics()
+    metrics.set_run_status("install-pkgs", 0)
+    metrics.set_run_status("install-pkgs", 2)
+
+    assert metrics.get("run_status", frecklecutable="install-pkgs", status="failed") == 1
+    assert metrics.get("run_status", frecklecutable="install-pkgs", status="succeeded") == 0
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.preflight`."""
+
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+if sys.version_info < (3, 5):
+    pytest.skip("asyncio support requires Python 3.5+", allow_module_level=True)
+
+from frecklecute.preflight import HostProber, ProbeResult, parse_host
+
+
+@pytest.fixture
+def listening_socket():
+    """A local socket that accepts connections and sends an SSH banner."""
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+    stop = threading.Event()
+
+    def serve():
+        server.settimeout(0.1)
+        while not stop.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            conn.sendall(b"SSH-2.0-OpenSSH_7.6\r\n")
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    yield server.getsockname()[1]
+    stop.set()
+    thread.join()
+    server.close()
+
+
+def get_closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def test_parse_host():
+    assert parse_host("markus@example.com") == ("example.com", None)
+    assert parse_host("example.com:2222") == ("example.com", 2222)
+    assert parse_host("[::1]:22") == ("::1", 22)
+    assert parse_host("fe80::1") == ("fe80::1", None)
+
+
+def test_probe_hosts(listening_socket):
+    reachable = "127.0.0.1:{}".format(listening_socket)
+    unreachable = "127.0.0.1:{}".format(get_closed_port())
+
+    prober = HostProber(timeout=2)
+    results = prober.check_hosts(["localhost", reachable, unreachable])
+
+    assert [r.host for r in results] == ["localhost", reachable, unreachable]
+    assert [r.reachable for r in results] == [True, True, False]
+    assert [r.method for r in results] == ["local", "ssh", "tcp"]
+    assert results[2].error
+
+
+def test_malformed_host(listening_socket):
+    reachable = "127.0.0.1:{}".format(listening_socket)
+
+    results = HostProber(timeout=2).check_hosts(["web1:abc", reachable])
+
+    assert [r.reachable for r in results] == [False, True]
+    assert results[0].method == "parse"
+    assert "Invalid port" in results[0].error
+
+
+def test_banner_check():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    try:
+        # the socket accepts connections (backlog), but never sends a banner
+        host = "127.0.0.1:{}".format(server.getsockname()[1])
+
+        result = HostProber(timeout=0.5).check_hosts([host])[0]
+        assert not result.reachable
+        assert "timed out" in result.error
+
+        result = HostProber(timeout=0.5, check_banner=False).check_hosts([host])[0]
+        assert result.reachable
+    finally:
+        server.close()
+
+
+def test_results_are_cached(listening_socket):
+    host = "127.0.0.1:{}".format(listening_socket)
+    prober = HostProber(timeout=2, cache_ttl=60)
+
+    first = prober.check_hosts([host])[0]
+    second = prober.check_hosts([host])[0]
+    assert first is second
+
+    prober.cache_ttl = 0
+    first.timestamp -= 1
+    assert prober.check_hosts([host])[0] is not first
+
+
+def test_results_are_shared_via_cache_file(tmpdir):
+    cache_path = str(tmpdir.join("preflight.json"))
+    result = ProbeResult("web1", False, "tcp", error="timed out")
+    prober = HostProber(cache_path=cache_path)
+    prober.cache[prober._cache_key("web1")] = result
+    prober.save_cache()
+    assert not os.stat(cache_path).st_mode & 0o022
+
+    # a new prober (e.g. of the next command-line run) re-uses the result, without probing the host
+    cached = HostProber(cache_path=cache_path).check_hosts(["web1"])[0]
+    assert cached.to_dict() == result.to_dict()
+
+    # results of differently configured probers are not re-used
+    other = HostProber(cache_path=cache_path, check_banner=False)
+    other.load_cache()
+    assert other._get_cached("web1") is None
+
+
+@pytest.mark.skipif(not any(os.access(os.path.join(p, "ssh"), os.X_OK) for p in os.environ.get("PATH", "").split(os.pathsep)),
+                    reason="ssh client not available")
+def test_ssh_config_is_used(tmpdir, listening_socket):
+    ssh_config = str(tmpdir.join("ssh_config"))
+    with open(ssh_config, "w") as f:
+        f.write("Host web1\n  HostName 127.0.0.1\n  Port {}\n".format(listening_socket))
+        f.write("Host inner\n  HostName 10.0.0.1\n  ProxyJump bastion\n")
+
+    results = HostProber(timeout=2, ssh_config=ssh_config).check_hosts(["web1", "inner", "web1:{}".format(get_closed_port())])
+
+    assert [r.reachable for r in results] == [True, True, False]
+    assert [r.method for r in results] == ["ssh", "skipped", "tcp"]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.roles`."""
+
+import os
+import tarfile
+
+from frecklecute.frecklecute import Frecklecutable, Frecklecute
+from frecklecute.roles import RoleStore, index_local_roles, parse_role_specs, role_spec_to_nsbl
+
+
+def create_role(parent, name, content="- debug: msg=hello\n"):
+    for folder, file_content in [("tasks", content), ("meta", "galaxy_info: {}\n")]:
+        os.makedirs(os.path.join(parent, name, folder))
+        with open(os.path.join(parent, name, folder, "main.yml"), "w") as f:
+            f.write(file_content)
+    return os.path.join(parent, name)
+
+
+def test_parse_role_specs():
+    specs = parse_role_specs(["geerlingguy.docker", {"name": "java", "version": "1.0"}, {"nginx": "/opt/roles/nginx"}])
+
+    assert specs == [
+        {"name": "geerlingguy.docker", "src": "geerlingguy.docker", "version": None},
+        {"name": "java", "src": None, "version": "1.0"},
+        {"name": "nginx", "src": "/opt/roles/nginx", "version": None},
+    ]
+    assert role_spec_to_nsbl(specs[0]) == "geerlingguy.docker"
+    assert role_spec_to_nsbl(specs[1]) == {"name": "java", "version": "1.0"}
+
+
+def test_prefetch_deduplicates(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "role_a")
+    archive_src = create_role(str(tmpdir.mkdir("archive_src")), "role_b")
+    with tarfile.open(os.path.join(repo, "role_b-1.0.tar.gz"), "w:gz") as tf:
+        tf.add(archive_src, arcname="role_b")
+
+    store = RoleStore(path=str(tmpdir.join("store")), role_repos=[repo])
+    missing = store.prefetch(["role_a", {"name": "role_b", "version": "1.0"}, "role_c"])
+
+    assert [spec["name"] for spec in missing] == ["role_c"]
+    # both roles have the same content
+    assert len(os.listdir(store.objects_path)) == 1
+    stored, _ = store.checkout(["role_a", {"name": "role_b", "version": "1.0"}])
+    assert stored["role_a"] == stored["role_b"]
+
+
+def read_role(path):
+    with open(os.path.join(path, "tasks", "main.yml")) as f:
+        return f.read()
+
+
+def test_checkout_by_source(tmpdir):
+    role_a = create_role(str(tmpdir.mkdir("a")), "nginx", content="a")
+    role_b = create_role(str(tmpdir.mkdir("b")), "nginx", content="b")
+    store = RoleStore(path=str(tmpdir.join("store")))
+
+    stored, _ = store.checkout({"nginx": role_a})
+    assert read_role(stored["nginx"]) == "a"
+    stored, _ = store.checkout({"nginx": role_b})
+    assert read_role(stored["nginx"]) == "b"
+
+    with open(os.path.join(role_a, "tasks", "main.yml"), "w") as f:
+        f.write("changed")
+    stored, _ = store.checkout({"nginx": role_a})
+    assert read_role(stored["nginx"]) == "changed"
+
+
+def test_missing_roles_are_remembered(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    store = RoleStore(path=str(tmpdir.join("store")), role_repos=[repo])
+
+    _, missing = store.checkout(["role_a"])
+    assert [spec["name"] for spec in missing] == ["role_a"]
+
+    create_role(repo, "role_a")
+    # the repositories are not searched again until the ttl expires
+    stored, missing = RoleStore(path=store.path, role_repos=[repo]).checkout(["role_a"])
+    assert not stored
+    stored, missing = RoleStore(path=store.path, role_repos=[repo], missing_ttl=0).checkout(["role_a"])
+    assert list(stored.keys()) == ["role_a"]
+    assert not missing
+
+
+def test_link_roles(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "role_a")
+    store = RoleStore(path=str(tmpdir.join("store")), role_repos=[repo])
+
+    stored, missing = store.checkout(["role_a", "role_c"])
+    target = str(tmpdir.join("env", "roles", "external"))
+    store.link_roles(stored, target)
+
+    assert [spec["name"] for spec in missing] == ["role_c"]
+    assert os.path.islink(os.path.join(target, "role_a"))
+    assert os.path.isfile(os.path.join(target, "role_a", "tasks", "main.yml"))
+
+
+def test_lru_eviction(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "role_a", content="a" * 1000)
+    create_role(repo, "role_b", content="b" * 1000)
+    store = RoleStore(path=str(tmpdir.join("store")), max_size=1500, role_repos=[repo], min_age=0)
+
+    stored_a, _ = store.checkout(["role_a"])
+    stored_b, _ = store.checkout(["role_b"])
+
+    assert not os.path.exists(stored_a["role_a"])
+    assert os.path.exists(stored_b["role_b"])
+
+
+def test_eviction_keeps_recently_used_and_counts_unindexed(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "role_a", content="a" * 1000)
+    create_role(repo, "role_b", content="b" * 1000)
+    store = RoleStore(path=str(tmpdir.join("store")), max_size=1500, role_repos=[repo])
+
+    # objects that were never added to the index still count towards the size limit
+    digest_a = store.add(os.path.join(repo, "role_a"))
+    stored_b, _ = store.checkout(["role_b"])
+    index = store.load_index()
+    assert digest_a in index["objects"].keys()
+    # but recently used roles are not evicted
+    assert os.path.exists(os.path.join(store.objects_path, digest_a))
+
+    with store.locked_index() as index:
+        index["objects"][digest_a]["last_used"] = 0
+    store.evict()
+    assert not os.path.exists(os.path.join(store.objects_path, digest_a))
+    assert os.path.exists(stored_b["role_b"])
+
+
+def test_versions_and_remote_sources_are_not_matched_by_name(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "java")
+    create_role(repo, "nginx")
+    store = RoleStore(path=str(tmpdir.join("store")), role_repos=[repo])
+
+    stored, missing = store.checkout([{"name": "java", "version": "2.0"}, {"name": "java", "version": "3.0"},
+                                      {"name": "nginx", "src": "https://github.com/example/ansible-nginx.git"}])
+
+    assert not stored
+    assert [(spec["name"], spec["version"]) for spec in missing] == [("java", "2.0"), ("java", "3.0"), ("nginx", None)]
+
+
+def test_index_local_roles(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    create_role(repo, "role_a")
+    create_role(os.path.join(repo, ".git"), "role_b")
+    create_role(os.path.join(repo, ".tox"), "role_c")
+    # not a role for nsbl, no 'meta/main.yml'
+    os.makedirs(os.path.join(repo, "files", "tasks"))
+    linked = create_role(str(tmpdir.mkdir("elsewhere")), "role_d")
+    os.symlink(os.path.dirname(linked), os.path.join(repo, "link"))
+
+    assert list(index_local_roles([repo]).keys()) == ["role_a"]
+
+
+def test_prepare_run_callback(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    role_path = create_role(str(tmpdir.mkdir("roles")), "role_a")
+    store = RoleStore(path=str(tmpdir.join("store")), role_repos=[repo])
+    f = Frecklecutable("test", [{"role_a": {}}], {}, tasks_format="freckles",
+                       additional_roles=[{"role_a": role_path}, "geerlingguy.java"])
+
+    callback, additional_roles = Frecklecute(f, role_store=store).prepare_run_callback(f)
+
+    # roles from the store are not handled by nsbl anymore, everything else is
+    assert additional_roles == ["geerlingguy.java"]
+
+    env_dir = str(tmpdir.mkdir("env"))
+    callback(env_dir)
+    # nsbl's ansible.cfg has 'roles/external' in the 'roles_path'
+    linked_role = os.path.join(env_dir, "roles", "external", "role_a")
+    assert os.path.islink(linked_role)
+    assert os.path.isfile(os.path.join(linked_role, "tasks", "main.yml"))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.utils`."""
+
+import copy
+import os
+import pickle
+
+import pytest
+
+from frecklecute.utils import FrecklecutableEntry, FrecklecutableFinder
+
+
+def create_frecklecutables(parent, names):
+    os.makedirs(parent)
+    for name in names:
+        with open(os.path.join(parent, name), "w") as f:
+            f.write("tasks:\n  - debug\n")
+
+
+def test_finder_index(tmpdir):
+    repo_1 = str(tmpdir.join("repo_1"))
+    repo_2 = str(tmpdir.join("repo_2"))
+    create_frecklecutables(os.path.join(repo_1, "frecklecutables"), ["install-pkgs", "create-user"])
+    create_frecklecutables(repo_2, ["create-user", "ignored.yml"])
+
+    finder = FrecklecutableFinder([repo_1, repo_2])
+    dictlets = finder.get_all_dictlets()
+
+    assert sorted(dictlets.keys()) == ["create-user", "install-pkgs"]
+    assert dict(dictlets["create-user"]) == {"path": os.path.join(os.path.realpath(repo_2), "create-user"), "type": "file"}
+    assert finder.get_dictlet("install-pkgs") is dictlets["install-pkgs"]
+    assert finder.get_dictlet("not-there") is None
+
+    # repeated calls don't copy or rescan
+    assert finder.get_all_dictlets()["install-pkgs"] is dictlets["install-pkgs"]
+
+
+def test_entries_share_folders(tmpdir):
+    repo = str(tmpdir.join("repo"))
+    create_frecklecutables(repo, ["a", "b"])
+
+    finder = FrecklecutableFinder([repo])
+    entries = list(finder.get_all_dictlets().values())
+
+    assert entries[0].folder is entries[1].folder
+    assert not hasattr(entries[0], "__dict__")
+    with pytest.raises(KeyError):
+        entries[0]["name"]
+
+
+def test_entry_mapping():
+    entry = FrecklecutableEntry("a", "/tmp", "a")
+
+    assert entry["path"] == os.path.join("/tmp", "a")
+    assert entry.get("type") == "file"
+    assert len(entry) == 2
+
+
+def test_dictlets_can_be_copied(tmpdir):
+    repo = str(tmpdir.join("repo"))
+    create_frecklecutables(repo, ["a"])
+    dictlets = FrecklecutableFinder([repo]).get_all_dictlets()
+
+    assert isinstance(dictlets, dict)
+    assert copy.deepcopy(dictlets) == dictlets
+    restored = pickle.loads(pickle.dumps(dictlets))
+    assert restored["a"]["path"] == dictlets["a"]["path"]
+    assert dict(dictlets["a"]) == {"path": dictlets["a"]["path"], "type": "file"}
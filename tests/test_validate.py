@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `frecklecute.validate`."""
+
+import os
+
+from frecklecute.validate import (ValidationState, calculate_file_digest, check_arg_spec, create_sample_vars,
+                                  find_referenced_files, get_arg_spec, validate_frecklecutables)
+
+
+def test_arg_spec():
+    assert list(get_arg_spec({"args": ["user", {"port": {"type": "int"}}]}).keys()) == ["user", "port"]
+
+    errors, warnings = check_arg_spec({"user": {"required": "yes", "colour": "red"}, "port": {"type": "int"}})
+    assert errors == ["Value of 'required' for arg 'user' needs to be a boolean"]
+    assert warnings == ["Unknown key 'colour' for arg 'user'"]
+
+
+def test_create_sample_vars():
+    arg_spec = {"user": {}, "port": {"type": "int"}, "shell": {"default": "/bin/bash"}, "groups": {"multiple": True}}
+    sample_vars = create_sample_vars(arg_spec, defaults={"user": "root"})
+
+    assert sample_vars["user"] == "root"
+    assert sample_vars["port"] == 1
+    assert sample_vars["shell"] == "/bin/bash"
+    assert sample_vars["groups"] == ["sample_groups"]
+
+
+def test_unchanged_files_are_skipped(tmpdir):
+    path = str(tmpdir.join("frecklecutable"))
+    with open(path, "w") as f:
+        f.write("tasks:\n  - debug\n")
+    state = ValidationState(path=str(tmpdir.join("validated.json")))
+    state.update(path, calculate_file_digest(path), True)
+
+    results = list(validate_frecklecutables({"frecklecutable": {"path": path, "type": "file"}}, state=state))
+
+    assert len(results) == 1
+    assert results[0]["skipped"]
+    assert not os.path.exists(state.path)
+
+
+def test_changed_dependencies_are_not_skipped(tmpdir):
+    path = str(tmpdir.join("frecklecutable"))
+    task_list = str(tmpdir.join("extra_tasks.yml"))
+    for p in [path, task_list]:
+        with open(p, "w") as f:
+            f.write("- debug\n")
+    state = ValidationState(path=str(tmpdir.join("validated.json")))
+
+    dependencies = find_referenced_files({"extra": {"path": "extra_tasks.yml"}, "other": "not-a-file"}, str(tmpdir))
+    assert dependencies == [os.path.realpath(task_list)]
+
+    state.update(path, calculate_file_digest(path), True, dependencies=dependencies)
+    assert state.is_unchanged(path, calculate_file_digest(path))
+
+    with open(task_list, "a") as f:
+        f.write("- debug\n")
+    assert not state.is_unchanged(path, calculate_file_digest(path))
+
+
+def test_validate_good_and_broken_frecklecutables(tmpdir):
+    files = {
+        "good": "args:\n  user:\n    help: the user\n    default: root\ntasks:\n  - debug:\n      msg: hello\n",
+        "bad_yaml": "tasks: [debug\n",
+        "bad_args": "args:\n  user:\n    required: 'yes'\ntasks:\n  - debug\n",
+        "no_tasks": "args:\n  - user\n"
+    }
+    dictlets = {}
+    for name, content in files.items():
+        path = str(tmpdir.join(name))
+        with open(path, "w") as f:
+            f.write(content)
+        dictlets[name] = {"path": path, "type": "file"}
+    state = ValidationState(path=str(tmpdir.join("validated.json")))
+
+    results = dict((r["name"], r) for r in validate_frecklecutables(dictlets, processes=2, state=state))
+
+    assert sorted(results.keys()) == sorted(files.keys())
+    assert results["good"]["errors"] == []
+    assert results["bad_yaml"]["errors"][0].startswith("Can't parse file")
+    assert results["bad_args"]["errors"] == ["Value of 'required' for arg 'user' needs to be a boolean"]
+    assert results["no_tasks"]["errors"] == ["No tasks"]
+
+    # only the valid frecklecutable is skipped the next time
+    assert list(state.valid.keys()) == [dictlets["good"]["path"]]
+    results = dict((r["name"], r) for r in validate_frecklecutables(dictlets, processes=2, state=state))
+    assert results["good"].get("skipped", False)
+    assert not results["bad_yaml"].get("skipped", False)